@@ -4,15 +4,16 @@ Works with minimal schema (device_users, notification_hashes, user_analytics)
 No email dependencies - everything is device-token based
 """
 from fastapi import APIRouter, HTTPException, status
+from fastapi.responses import ORJSONResponse
 from typing import Dict, Any, List, Optional
 import logging
 from datetime import datetime, timezone
-import json
+import hashlib
 
 from app.core.database import db_manager
-from app.services.privacy_analytics_service import privacy_analytics_service
+from app.services.analytics_service import analytics_service
 
-router = APIRouter()
+router = APIRouter(default_response_class=ORJSONResponse)
 logger = logging.getLogger(__name__)
 
 def validate_device_token(device_token: str) -> str:
@@ -58,34 +59,14 @@ async def chat_with_ai(
             SELECT id, keywords FROM iosapp.device_users
             WHERE device_token = $1 AND notifications_enabled = true
         """
-        device_result = await db_manager.execute_query(device_query, device_token)
+        device = await db_manager.fetchrow(device_query, device_token)
         
-        if not device_result:
+        if device is None:
             raise HTTPException(status_code=404, detail="Device not found or notifications disabled")
         
-        device_id = device_result[0]['id']
-        keywords_raw = device_result[0]['keywords']
-        
-        logger.info(f"Raw keywords from DB: type={type(keywords_raw)}, value={repr(keywords_raw)}")
-        
-        # Handle JSONB field properly - fix the JSON parsing issue
-        if keywords_raw is None:
-            keywords = []
-        elif isinstance(keywords_raw, list):
-            keywords = keywords_raw  # Already a list
-        elif isinstance(keywords_raw, str):
-            # Handle JSON string from database
-            try:
-                parsed = json.loads(keywords_raw)
-                keywords = parsed if isinstance(parsed, list) else [str(parsed)]
-            except (json.JSONDecodeError, TypeError):
-                # Fallback: treat as single keyword
-                keywords = [keywords_raw] if keywords_raw.strip() else []
-        else:
-            # Handle other types (e.g., dict, number)
-            keywords = []
-            
-        logger.info(f"Processed keywords: type={type(keywords)}, value={keywords}")
+        device_id = device['id']
+        keywords_raw = device['keywords']
+        keywords = keywords_raw or []  # jsonb, decoded by the pool codec
         
         # Extract message from request
         user_message = chat_request.get("message", "").strip()
@@ -125,15 +106,18 @@ async def chat_with_ai(
         # Simple AI response logic (you can replace with actual AI service)
         ai_response = await generate_ai_response(user_message, context)
         
+        # One timestamp for both the analytics event and the response
+        now = datetime.now(timezone.utc).isoformat()
+        
         # Log chat interaction (with consent check)
         metadata = {
             "user_message": user_message[:200],  # Truncate for storage
             "response_length": len(ai_response),
             "context_keywords": keywords[:5],
-            "timestamp": datetime.now(timezone.utc).isoformat()
+            "timestamp": now
         }
         
-        await privacy_analytics_service.track_action_with_consent(
+        analytics_service.track_action(
             device_id, 
             'ai_chat', 
             metadata
@@ -152,7 +136,7 @@ async def chat_with_ai(
                     "recent_jobs_count": len(recent_notifications)
                 },
                 "conversation_id": str(device_id),
-                "timestamp": datetime.now(timezone.utc).isoformat()
+                "timestamp": now
             }
         }
         
@@ -177,22 +161,13 @@ async def analyze_job_with_ai(
             SELECT id, keywords FROM iosapp.device_users
             WHERE device_token = $1
         """
-        device_result = await db_manager.execute_query(device_query, device_token)
+        device = await db_manager.fetchrow(device_query, device_token)
         
-        if not device_result:
+        if device is None:
             raise HTTPException(status_code=404, detail="Device not found")
         
-        device_id = device_result[0]['id']
-        keywords = device_result[0]['keywords'] or []
-        
-        # Ensure keywords is properly formatted as list (parse JSON if needed)
-        if isinstance(keywords, str):
-            try:
-                keywords = json.loads(keywords) if keywords.startswith('[') else [keywords]
-            except json.JSONDecodeError:
-                keywords = [keywords] if keywords else []
-        elif keywords is None:
-            keywords = []
+        device_id = device['id']
+        keywords = device['keywords'] or []  # jsonb, decoded by the pool codec
         
         # Extract job info
         job_id = job_request.get("job_id")
@@ -211,16 +186,17 @@ async def analyze_job_with_ai(
             FROM scraper.jobs_jobpost
             WHERE id = $1
         """
-        job_result = await db_manager.execute_query(job_query, job_id)
+        job = await db_manager.fetchrow(job_query, job_id)
         
-        if not job_result:
+        if job is None:
             raise HTTPException(status_code=404, detail="Job not found")
         
-        job = job_result[0]
-        
         # Generate AI analysis
         analysis = await generate_job_analysis(job, keywords)
         
+        # One timestamp for both the analytics event and the response
+        now = datetime.now(timezone.utc).isoformat()
+        
         # Log job analysis (with consent check)
         metadata = {
             "job_id": job_id,
@@ -228,10 +204,10 @@ async def analyze_job_with_ai(
             "job_company": job['company'][:50],
             "analysis_type": "ai_analysis",
             "user_keywords": keywords[:5],
-            "timestamp": datetime.now(timezone.utc).isoformat()
+            "timestamp": now
         }
         
-        await privacy_analytics_service.track_action_with_consent(
+        analytics_service.track_action(
             device_id, 
             'job_analysis', 
             metadata
@@ -248,7 +224,7 @@ async def analyze_job_with_ai(
                 },
                 "analysis": analysis,
                 "match_score": calculate_match_score(job, keywords),
-                "timestamp": datetime.now(timezone.utc).isoformat()
+                "timestamp": now
             }
         }
         
@@ -273,22 +249,13 @@ async def get_ai_recommendations(
             SELECT id, keywords FROM iosapp.device_users
             WHERE device_token = $1
         """
-        device_result = await db_manager.execute_query(device_query, device_token)
+        device = await db_manager.fetchrow(device_query, device_token)
         
-        if not device_result:
+        if device is None:
             raise HTTPException(status_code=404, detail="Device not found")
         
-        device_id = device_result[0]['id']
-        keywords = device_result[0]['keywords'] or []
-        
-        # Ensure keywords is properly formatted as list (parse JSON if needed)
-        if isinstance(keywords, str):
-            try:
-                keywords = json.loads(keywords) if keywords.startswith('[') else [keywords]
-            except json.JSONDecodeError:
-                keywords = [keywords] if keywords else []
-        elif keywords is None:
-            keywords = []
+        device_id = device['id']
+        keywords = device['keywords'] or []  # jsonb, decoded by the pool codec
         
         if not keywords:
             raise HTTPException(status_code=400, detail="No keywords set for recommendations")
@@ -327,9 +294,6 @@ async def get_ai_recommendations(
         """
         
         # Create LIKE patterns from keywords
-        # Ensure keywords is a list
-        if isinstance(keywords, str):
-            keywords = json.loads(keywords) if keywords.startswith('[') else [keywords]
         like_patterns = [f"%{keyword.lower()}%" for keyword in keywords]
         
         recommendations_result = await db_manager.execute_query(
@@ -369,7 +333,7 @@ async def get_ai_recommendations(
             "timestamp": datetime.now(timezone.utc).isoformat()
         }
         
-        await privacy_analytics_service.track_action_with_consent(
+        analytics_service.track_action(
             device_id, 
             'ai_recommendations', 
             metadata
@@ -401,22 +365,9 @@ async def generate_ai_response(user_message: str, context: Dict[str, Any]) -> st
     """Generate intelligent AI response using real job market data and analytics"""
     
     message_lower = user_message.lower()
-    keywords_raw = context.get("user_keywords", [])
+    keywords = context.get("user_keywords") or []
     recent_jobs = context.get("recent_jobs", [])
     
-    # Process keywords properly
-    if isinstance(keywords_raw, str):
-        try:
-            keywords = json.loads(keywords_raw)
-            if not isinstance(keywords, list):
-                keywords = [str(keywords)]
-        except:
-            keywords = [k.strip() for k in keywords_raw.replace(",", " ").split() if k.strip()]
-    elif isinstance(keywords_raw, list):
-        keywords = keywords_raw
-    else:
-        keywords = []
-    
     logger.info(f"AI Processing: keywords={keywords}, message='{user_message[:50]}...'")
     
     try:
@@ -764,7 +715,6 @@ async def generate_career_strategy(keywords: List[str], market_data: Dict, recen
     keyword_str = ", ".join(keywords) if keywords else "your skills"
     
     # Add variation to prevent identical responses
-    import hashlib
     message_hash = hashlib.md5(user_message.encode()).hexdigest()[:8]
     
     # Vary response format based on message content
@@ -4,13 +4,17 @@ Works with minimal schema - no email dependencies
 All operations are device-token based
 """
 from fastapi import APIRouter, HTTPException, status
+from fastapi.responses import ORJSONResponse
 from typing import Dict, Any, List, Optional
+import asyncio
 import logging
 from datetime import datetime, timezone
-import json
+import asyncpg
 
 from app.core.database import db_manager
+from app.core.redis_client import redis_client
 from app.services.privacy_analytics_service import privacy_analytics_service
+from app.services.analytics_service import analytics_service
 # from app.utils.validation import validate_device_token
 
 def validate_device_token(device_token: str) -> str:
@@ -19,9 +23,19 @@ def validate_device_token(device_token: str) -> str:
         raise HTTPException(status_code=400, detail="Invalid device token")
     return device_token
 
-router = APIRouter()
+router = APIRouter(default_response_class=ORJSONResponse)
 logger = logging.getLogger(__name__)
 
+# Static text so the prepared statement is reused; NULL leaves a field unchanged
+UPDATE_DEVICE_SQL = """
+    UPDATE iosapp.device_users
+    SET keywords = COALESCE($2, keywords),
+        notifications_enabled = COALESCE($3, notifications_enabled),
+        created_at = NOW()
+    WHERE id = $1
+    RETURNING keywords, notifications_enabled, created_at
+"""
+
 @router.get("/status/{device_token}")
 async def get_device_status(device_token: str):
     """Get device registration and setup status"""
@@ -39,16 +53,16 @@ async def get_device_status(device_token: str):
             FROM iosapp.device_users
             WHERE device_token = $1
         """
-        device_result = await db_manager.execute_query(device_query, device_token)
+        device = await db_manager.fetchrow(device_query, device_token)
         
-        if not device_result:
+        if device is None:
             return {
                 "success": False,
                 "registered": False,
                 "message": "Device not found - registration required"
             }
         
-        device_data = device_result[0]
+        device_data = device
         keywords = device_data['keywords'] or []
         
         # Check if setup is complete
@@ -83,60 +97,43 @@ async def update_device(device_token: str, update_data: Dict[str, Any]):
         # Validate device token
         device_token = validate_device_token(device_token)
         
-        # Get device info
-        device_query = """
-            SELECT id FROM iosapp.device_users
-            WHERE device_token = $1
-        """
-        device_result = await db_manager.execute_query(device_query, device_token)
+        # Get device_id (cached per token)
+        device_id = await db_manager.get_device_id(device_token)
         
-        if not device_result:
+        if device_id is None:
             raise HTTPException(status_code=404, detail="Device not found")
         
-        device_id = device_result[0]['id']
-        
         # Extract update fields
         keywords = update_data.get("keywords")
         notifications_enabled = update_data.get("notifications_enabled")
         
-        # Build dynamic update query
-        update_fields = []
-        params = []
-        param_count = 0
-        
-        if keywords is not None:
-            param_count += 1
-            update_fields.append(f"keywords = ${param_count}")
-            params.append(json.dumps(keywords))
-        
-        if notifications_enabled is not None:
-            param_count += 1
-            update_fields.append(f"notifications_enabled = ${param_count}")
-            params.append(notifications_enabled)
-        
-        if not update_fields:
+        if keywords is None and notifications_enabled is None:
             raise HTTPException(status_code=400, detail="No valid fields to update")
         
-        # Always update timestamp
-        update_fields.append("created_at = NOW()")
-        
-        # Add device_id parameter
-        param_count += 1
-        params.append(device_id)
-        
-        update_query = f"""
-            UPDATE iosapp.device_users
-            SET {', '.join(update_fields)}
-            WHERE id = ${param_count}
-            RETURNING keywords, notifications_enabled, created_at
-        """
+        updated_device = await db_manager.fetchrow(
+            UPDATE_DEVICE_SQL,
+            device_id,
+            keywords,
+            notifications_enabled
+        )
         
-        result = await db_manager.execute_query(update_query, *params)
+        if updated_device is None:
+            # Cached id outlived the row - re-resolve once in case the device re-registered
+            fresh_id = await db_manager.refresh_device_id(device_token)
+            if fresh_id is not None and fresh_id != device_id:
+                device_id = fresh_id
+                updated_device = await db_manager.fetchrow(
+                    UPDATE_DEVICE_SQL,
+                    device_id,
+                    keywords,
+                    notifications_enabled
+                )
+        
+        if updated_device is None:
+            raise HTTPException(status_code=404, detail="Device not found")
         
-        if not result:
-            raise HTTPException(status_code=500, detail="Failed to update device")
+        db_manager.forget_device_profiles(device_token)
         
-        updated_device = result[0]
         updated_keywords = updated_device['keywords'] or []
         
         # Log the update (with consent check)
@@ -147,7 +144,7 @@ async def update_device(device_token: str, update_data: Dict[str, Any]):
             "timestamp": datetime.now(timezone.utc).isoformat()
         }
         
-        await privacy_analytics_service.track_action_with_consent(
+        analytics_service.track_action(
             device_id,
             'device_updated',
             metadata
@@ -179,26 +176,19 @@ async def delete_device(device_token: str):
         # Validate device token
         device_token = validate_device_token(device_token)
         
-        # Get device info before deletion
-        device_query = """
-            SELECT id FROM iosapp.device_users
-            WHERE device_token = $1
-        """
-        device_result = await db_manager.execute_query(device_query, device_token)
+        # Get device_id (cached per token)
+        device_id = await db_manager.get_device_id(device_token)
         
-        if not device_result:
+        if device_id is None:
             raise HTTPException(status_code=404, detail="Device not found")
         
-        device_id = device_result[0]['id']
-        
         # Count associated data before deletion
         counts_query = """
             SELECT 
                 (SELECT COUNT(*) FROM iosapp.notification_hashes WHERE device_id = $1) as notifications,
                 (SELECT COUNT(*) FROM iosapp.user_analytics WHERE device_id = $1) as analytics
         """
-        counts_result = await db_manager.execute_query(counts_query, device_id)
-        counts = counts_result[0] if counts_result else {"notifications": 0, "analytics": 0}
+        counts = await db_manager.fetchrow(counts_query, device_id)
         
         # Delete device (CASCADE will handle related records)
         delete_query = """
@@ -208,9 +198,11 @@ async def delete_device(device_token: str):
         """
         
         delete_result = await db_manager.execute_query(delete_query, device_id)
+        db_manager.forget_device_tokens(device_token)
         
         if not delete_result:
-            raise HTTPException(status_code=500, detail="Failed to delete device")
+            # Cached id outlived the row (deleted elsewhere)
+            raise HTTPException(status_code=404, detail="Device not found")
         
         return {
             "success": True,
@@ -244,30 +236,27 @@ async def get_device_analytics(device_token: str, days: int = 30):
             SELECT id, created_at, keywords FROM iosapp.device_users
             WHERE device_token = $1
         """
-        device_result = await db_manager.execute_query(device_query, device_token)
+        device = await db_manager.fetchrow(device_query, device_token)
         
-        if not device_result:
+        if device is None:
             raise HTTPException(status_code=404, detail="Device not found")
         
-        device_id = device_result[0]['id']
-        device_created = device_result[0]['created_at']
-        keywords = device_result[0]['keywords'] or []
+        device_id = device['id']
+        device_created = device['created_at']
+        keywords = device['keywords'] or []
         
         # Get notification analytics
         notification_stats_query = """
             SELECT 
                 COUNT(*) as total_notifications,
                 COUNT(DISTINCT DATE(sent_at)) as active_days,
-                COUNT(*) FILTER (WHERE sent_at >= NOW() - INTERVAL '%s days') as recent_notifications,
+                COUNT(*) FILTER (WHERE sent_at >= NOW() - make_interval(days => $2)) as recent_notifications,
                 array_agg(DISTINCT job_source) FILTER (WHERE job_source IS NOT NULL) as sources,
                 MIN(sent_at) as first_notification,
                 MAX(sent_at) as last_notification
             FROM iosapp.notification_hashes
             WHERE device_id = $1
-        """ % days
-        
-        notification_stats = await db_manager.execute_query(notification_stats_query, device_id)
-        stats = notification_stats[0] if notification_stats else {}
+        """
         
         # Get daily notification breakdown
         daily_stats_query = """
@@ -276,16 +265,20 @@ async def get_device_analytics(device_token: str, days: int = 30):
                 COUNT(*) as notification_count,
                 array_agg(DISTINCT job_source) as sources
             FROM iosapp.notification_hashes
-            WHERE device_id = $1 AND sent_at >= NOW() - INTERVAL '%s days'
+            WHERE device_id = $1 AND sent_at >= NOW() - make_interval(days => $2)
             GROUP BY DATE(sent_at)
             ORDER BY date DESC
-        """ % days
+        """
         
-        daily_stats = await db_manager.execute_query(daily_stats_query, device_id)
+        # The stats, daily breakdown and consent check are independent; run them concurrently
+        stats, daily_stats, analytics_consent = await asyncio.gather(
+            db_manager.fetchrow(notification_stats_query, device_id, days),
+            db_manager.execute_query(daily_stats_query, device_id, days),
+            privacy_analytics_service.check_analytics_consent(device_id)
+        )
         
         # Get user analytics events (only if user has consented)
         events_stats = []
-        analytics_consent = await privacy_analytics_service.check_analytics_consent(device_id)
         
         if analytics_consent:
             events_query = """
@@ -294,12 +287,12 @@ async def get_device_analytics(device_token: str, days: int = 30):
                     COUNT(*) as count,
                     MAX(created_at) as last_event
                 FROM iosapp.user_analytics
-                WHERE device_id = $1 AND created_at >= NOW() - INTERVAL '%s days'
+                WHERE device_id = $1 AND created_at >= NOW() - make_interval(days => $2)
                 GROUP BY action
                 ORDER BY count DESC
-            """ % days
+            """
             
-            events_stats = await db_manager.execute_query(events_query, device_id)
+            events_stats = await db_manager.execute_query(events_query, device_id, days)
         
         # Calculate days since registration
         days_since_registration = 0
@@ -360,49 +353,39 @@ async def refresh_device_token(old_device_token: str, new_token_data: Dict[str,
         old_device_token = validate_device_token(old_device_token)
         new_device_token = validate_device_token(new_token_data.get("new_device_token", ""))
         
-        # Check if old device exists
-        old_device_query = """
-            SELECT id, keywords, notifications_enabled FROM iosapp.device_users
-            WHERE device_token = $1
-        """
-        old_device_result = await db_manager.execute_query(old_device_query, old_device_token)
-        
-        if not old_device_result:
-            raise HTTPException(status_code=404, detail="Old device not found")
-        
-        old_device = old_device_result[0]
-        
-        # Check if new token already exists
-        new_device_query = """
-            SELECT id FROM iosapp.device_users
-            WHERE device_token = $1
-        """
-        new_device_result = await db_manager.execute_query(new_device_query, new_device_token)
-        
-        if new_device_result:
+        if new_device_token == old_device_token:
             raise HTTPException(status_code=409, detail="New device token already exists")
         
-        # Update device token
+        # Swap the token in one statement: no row means the old device is unknown,
+        # and the unique device_token constraint rejects a new token already in use
         update_query = """
             UPDATE iosapp.device_users
             SET device_token = $1, created_at = NOW()
-            WHERE id = $2
-            RETURNING id
+            WHERE device_token = $2
+            RETURNING id, keywords, notifications_enabled
         """
         
-        update_result = await db_manager.execute_query(update_query, new_device_token, old_device['id'])
+        try:
+            old_device = await db_manager.fetchrow(update_query, new_device_token, old_device_token)
+        except asyncpg.UniqueViolationError:
+            raise HTTPException(status_code=409, detail="New device token already exists")
+        
+        if old_device is None:
+            raise HTTPException(status_code=404, detail="Old device not found")
         
-        if not update_result:
-            raise HTTPException(status_code=500, detail="Failed to update device token")
+        db_manager.forget_device_tokens(old_device_token)
+        
+        # One timestamp for both the analytics event and the response
+        now = datetime.now(timezone.utc).isoformat()
         
         # Log token refresh (with consent check)
         metadata = {
             "old_token_preview": old_device_token[:16] + "...",
             "new_token_preview": new_device_token[:16] + "...",
-            "timestamp": datetime.now(timezone.utc).isoformat()
+            "timestamp": now
         }
         
-        await privacy_analytics_service.track_action_with_consent(
+        analytics_service.track_action(
             old_device['id'],
             'token_refreshed',
             metadata
@@ -417,7 +400,7 @@ async def refresh_device_token(old_device_token: str, new_token_data: Dict[str,
                 "new_token_preview": new_device_token[:16] + "...",
                 "keywords": old_device['keywords'] or [],
                 "notifications_enabled": old_device['notifications_enabled'],
-                "refreshed_at": datetime.now(timezone.utc).isoformat()
+                "refreshed_at": now
             }
         }
         
@@ -443,6 +426,7 @@ async def cleanup_test_data():
         """
         
         deleted_devices = await db_manager.execute_query(cleanup_query)
+        db_manager.forget_device_tokens(*(d['device_token'] for d in deleted_devices))
         
         logger.info(f"Cleaned up {len(deleted_devices)} test device tokens")
         
@@ -463,23 +447,15 @@ async def cleanup_test_data():
 async def reset_notification_throttling(device_token: str):
     """Reset notification throttling for a device (development only)"""
     try:
-        from app.core.redis_client import redis_client
-        
         # Validate device token
         device_token = validate_device_token(device_token)
         
-        # Get device info
-        device_query = """
-            SELECT id FROM iosapp.device_users
-            WHERE device_token = $1
-        """
-        device_result = await db_manager.execute_query(device_query, device_token)
+        # Get device_id (cached per token)
+        device_id = await db_manager.get_device_id(device_token)
         
-        if not device_result:
+        if device_id is None:
             raise HTTPException(status_code=404, detail="Device not found")
         
-        device_id = str(device_result[0]['id'])
-        
         # Reset Redis counters
         await redis_client.reset_notification_count(device_id, "hour")
         await redis_client.reset_notification_count(device_id, "day")
@@ -528,8 +504,7 @@ async def debug_list_all_devices():
                 FROM iosapp.notification_hashes
                 WHERE device_id = $1
             """
-            notification_result = await db_manager.execute_query(notification_query, device['id'])
-            notification_count = notification_result[0]['count'] if notification_result else 0
+            notification_count = await db_manager.fetchval(notification_query, device['id'])
             
             result.append({
                 "device_id": str(device['id']),
@@ -4,14 +4,21 @@ Works with minimal schema (device_users, notification_hashes, user_analytics)
 No email dependencies - everything is device-token based
 """
 from fastapi import APIRouter, HTTPException, Query
-from typing import Dict, Any, Optional
+from fastapi.responses import ORJSONResponse
+from typing import Dict, Any, List, Optional
+import asyncio
 import logging
 from datetime import datetime, timezone
 import json
+import orjson
+import uuid
+import hashlib
+import re
 
 from app.core.database import db_manager
 from app.core.config import settings
-from app.services.privacy_analytics_service import privacy_analytics_service
+from app.services.analytics_service import analytics_service
+from app.services.minimal_notification_service import minimal_notification_service, MinimalNotificationService
 # from app.utils.validation import validate_device_token
 
 def validate_device_token(device_token: str) -> str:
@@ -42,9 +49,101 @@ def validate_device_token(device_token: str) -> str:
     
     return device_token
 
-router = APIRouter()
+router = APIRouter(default_response_class=ORJSONResponse)
 logger = logging.getLogger(__name__)
 
+def _json_value(value, default):
+    """json/jsonb columns arrive decoded by the pool codec; text columns may still hold JSON text"""
+    if not value:
+        return default
+    return orjson.loads(value) if isinstance(value, str) else value
+
+SESSION_JOBS_COUNT_SQL = """
+    SELECT COUNT(*) FROM iosapp.job_match_session_jobs
+    WHERE session_id = $1
+"""
+
+# Same device set as get_active_devices_with_keywords; a device matches a job when
+# any keyword is a substring of the lowercased title or company
+COMPAT_JOB_MATCH_COUNT_SQL = """
+    SELECT COUNT(*)
+    FROM unnest($1::text[], $2::text[]) AS j(title, company)
+    JOIN iosapp.device_users d
+        ON d.notifications_enabled = true
+        AND jsonb_array_length(d.keywords) > 0
+    WHERE EXISTS (
+        SELECT 1 FROM jsonb_array_elements_text(d.keywords) AS k(keyword)
+        WHERE strpos(j.title, lower(k.keyword)) > 0
+            OR strpos(j.company, lower(k.keyword)) > 0
+    )
+"""
+
+INBOX_TOUCH_DEVICE_SQL = """
+    UPDATE iosapp.device_users SET last_activity = NOW()
+    WHERE device_token = $1
+    RETURNING id, notifications_enabled
+"""
+
+UPDATE_SETTINGS_SQL = """
+    UPDATE iosapp.device_users
+    SET 
+        notifications_enabled = COALESCE($1, notifications_enabled),
+        keywords = COALESCE($2, keywords),
+        created_at = NOW()
+    WHERE device_token = $3
+    RETURNING id, notifications_enabled, keywords
+"""
+
+TEST_DEVICE_SQL = """
+    SELECT id, keywords FROM iosapp.device_users
+    WHERE device_token = $1 AND notifications_enabled = true
+"""
+
+# Per-id mark-read/delete in one round trip; only ids owned by the device match
+MARK_READ_BY_IDS_SQL = """
+    UPDATE iosapp.notification_hashes
+    SET is_read = true, read_at = NOW()
+    WHERE device_id = $1 AND id = ANY($2::uuid[]) AND is_read = false
+    RETURNING id
+"""
+
+DELETE_BY_IDS_SQL = """
+    DELETE FROM iosapp.notification_hashes
+    WHERE device_id = $1 AND id = ANY($2::uuid[])
+    RETURNING id
+"""
+
+def _valid_notification_ids(notification_ids: List[Any]) -> List[str]:
+    """Keep the ids that parse as UUIDs; malformed ones are skipped, as before"""
+    valid_ids = []
+    for notification_id in notification_ids:
+        try:
+            valid_ids.append(str(uuid.UUID(str(notification_id))))
+        except (ValueError, TypeError):
+            continue
+    return valid_ids
+
+async def _write_by_device_id(device_token: str, device_id: str, query: str, *args):
+    """
+    Run a RETURNING write keyed by a cached device id
+    
+    If nothing matched, the id is re-resolved once: a device deleted elsewhere
+    raises 404, and one that re-registered under a new id is retried with it.
+    
+    Returns:
+        Tuple[device_id, rows]: the id actually used and the returned rows
+    """
+    rows = await db_manager.execute_query(query, device_id, *args)
+    if rows:
+        return device_id, rows
+    
+    fresh_id = await db_manager.refresh_device_id(device_token)
+    if fresh_id is None:
+        raise HTTPException(status_code=404, detail="Device not found")
+    if fresh_id != device_id:
+        rows = await db_manager.execute_query(query, fresh_id, *args)
+    return fresh_id, rows
+
 async def update_user_activity(device_token: str):
     """Update last_activity timestamp for a device"""
     try:
@@ -68,16 +167,14 @@ async def get_notification_history(
         
         # Get device info
         device_query = """
-            SELECT id, keywords FROM iosapp.device_users
+            SELECT id FROM iosapp.device_users
             WHERE device_token = $1 AND notifications_enabled = true
         """
-        device_result = await db_manager.execute_query(device_query, device_token)
+        device_id = await db_manager.fetchval(device_query, device_token)
         
-        if not device_result:
+        if device_id is None:
             raise HTTPException(status_code=404, detail="Device not found or notifications disabled")
         
-        device_id = device_result[0]['id']
-        
         # Get notification history
         history_query = """
             SELECT 
@@ -89,7 +186,8 @@ async def get_notification_history(
                 matched_keywords,
                 sent_at,
                 is_read,
-                read_at
+                read_at,
+                COUNT(*) OVER () as total
             FROM iosapp.notification_hashes
             WHERE device_id = $1
             ORDER BY sent_at DESC
@@ -98,14 +196,16 @@ async def get_notification_history(
         
         history_result = await db_manager.execute_query(history_query, device_id, limit, offset)
         
-        # Get total count
-        count_query = """
-            SELECT COUNT(*) as total
-            FROM iosapp.notification_hashes
-            WHERE device_id = $1
-        """
-        count_result = await db_manager.execute_query(count_query, device_id)
-        total_count = count_result[0]['total'] if count_result else 0
+        # Total comes with the page; only a page past the end needs a separate count
+        if history_result:
+            total_count = history_result[0]['total']
+        elif offset > 0:
+            total_count = await db_manager.fetchval(
+                "SELECT COUNT(*) FROM iosapp.notification_hashes WHERE device_id = $1",
+                device_id
+            )
+        else:
+            total_count = 0
         
         # Format notifications
         notifications = []
@@ -115,7 +215,7 @@ async def get_notification_history(
             if notification['matched_keywords']:
                 try:
                     if isinstance(notification['matched_keywords'], str):
-                        matched_keywords = json.loads(notification['matched_keywords'])
+                        matched_keywords = orjson.loads(notification['matched_keywords'])
                     else:
                         matched_keywords = notification['matched_keywords']
                 except:
@@ -127,13 +227,13 @@ async def get_notification_history(
                 "job_company": notification['job_company'],
                 "job_source": notification['job_source'],
                 "matched_keywords": matched_keywords,
-                "sent_at": notification['sent_at'].isoformat() if notification['sent_at'] else None,
+                "sent_at": notification['sent_at'],
                 "job_hash": notification['job_hash'],
                 "is_read": notification.get('is_read', False),
-                "read_at": notification['read_at'].isoformat() if notification.get('read_at') else None
+                "read_at": notification['read_at']
             })
         
-        return {
+        return ORJSONResponse({
             "success": True,
             "data": {
                 "device_token_preview": device_token[:16] + "...",
@@ -146,7 +246,7 @@ async def get_notification_history(
                     "has_more": offset + limit < total_count
                 }
             }
-        }
+        })
         
     except HTTPException:
         raise
@@ -165,20 +265,13 @@ async def get_notification_inbox(
         # Validate device token
         device_token = validate_device_token(device_token)
         
-        # Update user activity
-        await update_user_activity(device_token)
-        
-        # Get device info
-        device_query = """
-            SELECT id FROM iosapp.device_users
-            WHERE device_token = $1 AND notifications_enabled = true
-        """
-        device_result = await db_manager.execute_query(device_query, device_token)
+        # Update user activity and get device info in one statement
+        device = await db_manager.fetchrow(INBOX_TOUCH_DEVICE_SQL, device_token)
         
-        if not device_result:
+        if device is None or not device['notifications_enabled']:
             raise HTTPException(status_code=404, detail="Device not found or notifications disabled")
         
-        device_id = device_result[0]['id']
+        device_id = device['id']
         
         if group_by_time:
             # Group notifications by day and keywords
@@ -194,7 +287,9 @@ async def get_notification_inbox(
                     MAX(sent_at) as latest_sent_at,
                     array_agg(id ORDER BY sent_at DESC) as notification_ids,
                     array_agg(is_read ORDER BY sent_at DESC) as read_statuses,
-                    COUNT(CASE WHEN is_read = false THEN 1 END) as unread_count
+                    COUNT(CASE WHEN is_read = false THEN 1 END) as unread_count,
+                    (SELECT COUNT(*) FROM iosapp.notification_hashes
+                     WHERE device_id = $1 AND is_read = false) as total_unread
                 FROM iosapp.notification_hashes
                 WHERE device_id = $1
                 GROUP BY DATE(sent_at), matched_keywords
@@ -203,6 +298,7 @@ async def get_notification_inbox(
             """
             
             grouped_result = await db_manager.execute_query(grouped_query, device_id, limit)
+            inbox_rows = grouped_result
             
             notifications = []
             for group in grouped_result:
@@ -211,7 +307,7 @@ async def get_notification_inbox(
                 if group['matched_keywords']:
                     try:
                         if isinstance(group['matched_keywords'], str):
-                            matched_keywords = json.loads(group['matched_keywords'])
+                            matched_keywords = orjson.loads(group['matched_keywords'])
                         else:
                             matched_keywords = group['matched_keywords']
                     except:
@@ -230,8 +326,8 @@ async def get_notification_inbox(
                     "job_count": job_count,
                     "unread_count": group['unread_count'],
                     "matched_keywords": matched_keywords,
-                    "notification_date": group['notification_date'].isoformat() if group['notification_date'] else None,
-                    "latest_sent_at": group['latest_sent_at'].isoformat() if group['latest_sent_at'] else None,
+                    "notification_date": group['notification_date'],
+                    "latest_sent_at": group['latest_sent_at'],
                     "notification_ids": [str(nid) for nid in group['notification_ids']],
                     "jobs": [
                         {
@@ -268,7 +364,9 @@ async def get_notification_inbox(
                     matched_keywords,
                     sent_at,
                     is_read,
-                    read_at
+                    read_at,
+                    (SELECT COUNT(*) FROM iosapp.notification_hashes
+                     WHERE device_id = $1 AND is_read = false) as total_unread
                 FROM iosapp.notification_hashes
                 WHERE device_id = $1
                 ORDER BY sent_at DESC
@@ -276,6 +374,7 @@ async def get_notification_inbox(
             """
             
             individual_result = await db_manager.execute_query(individual_query, device_id, limit)
+            inbox_rows = individual_result
             
             notifications = []
             for notification in individual_result:
@@ -284,7 +383,7 @@ async def get_notification_inbox(
                 if notification['matched_keywords']:
                     try:
                         if isinstance(notification['matched_keywords'], str):
-                            matched_keywords = json.loads(notification['matched_keywords'])
+                            matched_keywords = orjson.loads(notification['matched_keywords'])
                         else:
                             matched_keywords = notification['matched_keywords']
                     except:
@@ -297,9 +396,9 @@ async def get_notification_inbox(
                     "message": f"💼 {notification['job_company']} • {', '.join(matched_keywords[:2])}",
                     "job_count": 1,
                     "matched_keywords": matched_keywords,
-                    "sent_at": notification['sent_at'].isoformat() if notification['sent_at'] else None,
+                    "sent_at": notification['sent_at'],
                     "is_read": notification.get('is_read', False),
-                    "read_at": notification['read_at'].isoformat() if notification.get('read_at') else None,
+                    "read_at": notification['read_at'],
                     "jobs": [{
                         "title": notification['job_title'],
                         "company": notification['job_company'],
@@ -314,16 +413,19 @@ async def get_notification_inbox(
                     }]
                 })
         
-        # Get total unread count (all unread notifications)
-        unread_query = """
-            SELECT COUNT(*) as unread_count
-            FROM iosapp.notification_hashes
-            WHERE device_id = $1 AND is_read = false
-        """
-        unread_result = await db_manager.execute_query(unread_query, device_id)
-        unread_count = unread_result[0]['unread_count'] if unread_result else 0
+        # Total unread count (all unread notifications) comes with the page; an empty
+        # page only needs its own count when limit excluded every row
+        if inbox_rows:
+            unread_count = inbox_rows[0]['total_unread']
+        elif limit > 0:
+            unread_count = 0
+        else:
+            unread_count = await db_manager.fetchval(
+                "SELECT COUNT(*) FROM iosapp.notification_hashes WHERE device_id = $1 AND is_read = false",
+                device_id
+            )
         
-        return {
+        return ORJSONResponse({
             "success": True,
             "data": {
                 "notifications": notifications,
@@ -331,7 +433,7 @@ async def get_notification_inbox(
                 "total_shown": len(notifications),
                 "grouped": group_by_time
             }
-        }
+        })
         
     except HTTPException:
         raise
@@ -349,27 +451,27 @@ async def clear_notification_history(
         # Validate device token
         device_token = validate_device_token(device_token)
         
-        # Get device info
-        device_query = """
-            SELECT id FROM iosapp.device_users
-            WHERE device_token = $1
+        # Resolve the device and delete its old notifications in one statement
+        delete_query = """
+            WITH device AS (
+                SELECT id FROM iosapp.device_users
+                WHERE device_token = $1
+            ), deleted AS (
+                DELETE FROM iosapp.notification_hashes
+                WHERE device_id IN (SELECT id FROM device)
+                  AND sent_at < NOW() - make_interval(days => $2)
+                RETURNING id
+            )
+            SELECT (SELECT id FROM device) AS device_id,
+                   (SELECT COUNT(*) FROM deleted) AS deleted_count
         """
-        device_result = await db_manager.execute_query(device_query, device_token)
-        
-        if not device_result:
-            raise HTTPException(status_code=404, detail="Device not found")
         
-        device_id = device_result[0]['id']
+        result = await db_manager.fetchrow(delete_query, device_token, days_old)
         
-        # Delete old notifications
-        delete_query = """
-            DELETE FROM iosapp.notification_hashes
-            WHERE device_id = $1 AND sent_at < NOW() - INTERVAL '%s days'
-            RETURNING id
-        """ % days_old
+        if result['device_id'] is None:
+            raise HTTPException(status_code=404, detail="Device not found")
         
-        deleted_result = await db_manager.execute_query(delete_query, device_id)
-        deleted_count = len(deleted_result) if deleted_result else 0
+        deleted_count = result['deleted_count']
         
         return {
             "success": True,
@@ -390,21 +492,17 @@ async def send_test_notification(device_token: str):
         # Validate device token
         device_token = validate_device_token(device_token)
         
-        # Get device info
-        device_query = """
-            SELECT id, keywords FROM iosapp.device_users
-            WHERE device_token = $1 AND notifications_enabled = true
-        """
-        device_result = await db_manager.execute_query(device_query, device_token)
+        # Get device info while the (cached) APNs client is initialised
+        device, _ = await asyncio.gather(
+            db_manager.fetchrow(TEST_DEVICE_SQL, device_token),
+            minimal_notification_service.push_service._get_apns_client()
+        )
         
-        if not device_result:
+        if device is None:
             raise HTTPException(status_code=404, detail="Device not found or notifications disabled")
         
-        device_id = device_result[0]['id']
-        keywords = device_result[0]['keywords'] or []
-        
-        # Use minimal notification service to send test
-        from app.services.minimal_notification_service import minimal_notification_service
+        device_id = device['id']
+        keywords = device['keywords'] or []
         
         # Create test job
         test_job = {
@@ -422,7 +520,6 @@ async def send_test_notification(device_token: str):
         
         if success:
             # Record test notification
-            import hashlib
             job_hash = hashlib.md5(f"{test_job['title']}{test_job['company']}test".encode()).hexdigest()
             
             await minimal_notification_service.record_notification_sent(
@@ -454,38 +551,23 @@ async def update_device_notification_settings(
         # Validate device token
         device_token = validate_device_token(device_token)
         
-        # Get device info
-        device_query = """
-            SELECT id FROM iosapp.device_users
-            WHERE device_token = $1
-        """
-        device_result = await db_manager.execute_query(device_query, device_token)
+        # Update device settings by token; omitted settings (None) keep their current
+        # value, and no row back means unknown device
+        updated = await db_manager.fetchrow(
+            UPDATE_SETTINGS_SQL, 
+            settings.get("notifications_enabled"), 
+            settings.get("keywords"), 
+            device_token
+        )
         
-        if not device_result:
+        if updated is None:
             raise HTTPException(status_code=404, detail="Device not found")
         
-        device_id = device_result[0]['id']
-        
-        # Extract settings
-        notifications_enabled = settings.get("notifications_enabled", True)
-        keywords = settings.get("keywords", [])
+        db_manager.forget_device_profiles(device_token)
         
-        # Update device settings
-        update_query = """
-            UPDATE iosapp.device_users
-            SET 
-                notifications_enabled = $1,
-                keywords = $2,
-                created_at = NOW()
-            WHERE id = $3
-        """
-        
-        await db_manager.execute_command(
-            update_query, 
-            notifications_enabled, 
-            json.dumps(keywords), 
-            device_id
-        )
+        device_id = updated['id']
+        notifications_enabled = updated['notifications_enabled']
+        keywords = updated['keywords'] or []
         
         # Log settings change (with consent check)
         metadata = {
@@ -494,7 +576,7 @@ async def update_device_notification_settings(
             "timestamp": datetime.now(timezone.utc).isoformat()
         }
         
-        await privacy_analytics_service.track_action_with_consent(
+        analytics_service.track_action(
             device_id,
             'settings_updated',
             metadata
@@ -534,12 +616,11 @@ async def get_device_notification_settings(device_token: str):
             WHERE device_token = $1
         """
         
-        settings_result = await db_manager.execute_query(settings_query, device_token)
+        settings = await db_manager.fetchrow(settings_query, device_token)
         
-        if not settings_result:
+        if settings is None:
             raise HTTPException(status_code=404, detail="Device not found")
         
-        settings = settings_result[0]
         keywords = settings['keywords'] or []
         
         # Get notification stats
@@ -554,8 +635,7 @@ async def get_device_notification_settings(device_token: str):
             WHERE du.device_token = $1
         """
         
-        stats_result = await db_manager.execute_query(stats_query, device_token)
-        stats = stats_result[0] if stats_result else {}
+        stats = await db_manager.fetchrow(stats_query, device_token)
         
         return {
             "success": True,
@@ -596,17 +676,14 @@ async def mark_notifications_as_read(
         notification_ids = request_data.get("notification_ids", [])
         mark_all = request_data.get("mark_all", False)
         
-        # Get device info
-        device_query = """
-            SELECT id FROM iosapp.device_users
-            WHERE device_token = $1
-        """
-        device_result = await db_manager.execute_query(device_query, device_token)
+        # Get device_id (cached per token)
+        device_id = await db_manager.get_device_id(device_token)
         
-        if not device_result:
+        if device_id is None:
             raise HTTPException(status_code=404, detail="Device not found")
         
-        device_id = device_result[0]['id']
+        # One timestamp for every read event recorded by this request
+        read_at = datetime.now(timezone.utc).isoformat()
         
         if mark_all or not notification_ids:
             # Mark all notifications as read
@@ -616,16 +693,16 @@ async def mark_notifications_as_read(
                 WHERE device_id = $1 AND is_read = false
                 RETURNING id
             """
-            marked_result = await db_manager.execute_query(mark_all_query, device_id)
+            device_id, marked_result = await _write_by_device_id(device_token, device_id, mark_all_query)
             marked_count = len(marked_result) if marked_result else 0
             
             # Record bulk read event (with consent check)
             metadata = {
                 "notification_count": marked_count,
-                "read_at": datetime.now(timezone.utc).isoformat()
+                "read_at": read_at
             }
             
-            await privacy_analytics_service.track_action_with_consent(
+            analytics_service.track_action(
                 str(device_id),
                 'notifications_all_read',
                 metadata
@@ -634,40 +711,21 @@ async def mark_notifications_as_read(
             message = f"Marked all {marked_count} notifications as read"
         else:
             # Mark specific notifications as read
-            marked_count = 0
-            for notification_id in notification_ids:
-                try:
-                    import uuid
-                    notification_uuid = uuid.UUID(str(notification_id))
-                    
-                    # Update the specific notification
-                    mark_query = """
-                        UPDATE iosapp.notification_hashes
-                        SET is_read = true, read_at = NOW()
-                        WHERE device_id = $1 AND id = $2 AND is_read = false
-                        RETURNING id
-                    """
-                    mark_result = await db_manager.execute_query(mark_query, device_id, notification_uuid)
-                    
-                    if mark_result:
-                        marked_count += 1
-                        
-                        # Record read event in analytics (with consent check)
-                        metadata = {
-                            "notification_id": str(notification_id),
-                            "read_at": datetime.now(timezone.utc).isoformat()
-                        }
-                        
-                        await privacy_analytics_service.track_action_with_consent(
-                            str(device_id),
-                            'notification_read',
-                            metadata
-                        )
-                except (ValueError, TypeError):
-                    # Invalid UUID format, skip
-                    continue
-                except Exception:
-                    continue
+            device_id, marked_ids = await _write_by_device_id(
+                device_token, device_id, MARK_READ_BY_IDS_SQL, _valid_notification_ids(notification_ids)
+            )
+            marked_count = len(marked_ids)
+            
+            # Record read events in analytics (with consent check)
+            for row in marked_ids:
+                analytics_service.track_action(
+                    device_id,
+                    'notification_read',
+                    {
+                        "notification_id": str(row['id']),
+                        "read_at": read_at
+                    }
+                )
             
             message = f"Marked {marked_count} notifications as read"
         
@@ -703,18 +761,12 @@ async def delete_notifications(
         notification_ids = request_data.get("notification_ids", [])
         delete_all = request_data.get("delete_all", False)
         
-        # Get device info
-        device_query = """
-            SELECT id FROM iosapp.device_users
-            WHERE device_token = $1
-        """
-        device_result = await db_manager.execute_query(device_query, device_token)
+        # Get device_id (cached per token)
+        device_id = await db_manager.get_device_id(device_token)
         
-        if not device_result:
+        if device_id is None:
             raise HTTPException(status_code=404, detail="Device not found")
         
-        device_id = device_result[0]['id']
-        
         if delete_all:
             # Delete all notifications for device
             delete_all_query = """
@@ -722,7 +774,7 @@ async def delete_notifications(
                 WHERE device_id = $1
                 RETURNING id
             """
-            deleted_result = await db_manager.execute_query(delete_all_query, device_id)
+            device_id, deleted_result = await _write_by_device_id(device_token, device_id, delete_all_query)
             deleted_count = len(deleted_result) if deleted_result else 0
             
             # Log deletion (with consent check)
@@ -731,7 +783,7 @@ async def delete_notifications(
                 "deleted_at": datetime.now(timezone.utc).isoformat()
             }
             
-            await privacy_analytics_service.track_action_with_consent(
+            analytics_service.track_action(
                 str(device_id),
                 'notifications_all_deleted',
                 metadata
@@ -741,24 +793,10 @@ async def delete_notifications(
             
         elif notification_ids:
             # Delete specific notifications
-            deleted_count = 0
-            
-            for notification_id in notification_ids:
-                delete_query = """
-                    DELETE FROM iosapp.notification_hashes
-                    WHERE device_id = $1 AND id = $2
-                    RETURNING id
-                """
-                
-                try:
-                    import uuid
-                    notification_uuid = uuid.UUID(str(notification_id))
-                    delete_result = await db_manager.execute_query(delete_query, device_id, notification_uuid)
-                    if delete_result:
-                        deleted_count += 1
-                except (ValueError, TypeError):
-                    # Invalid UUID format, skip
-                    continue
+            device_id, deleted_result = await _write_by_device_id(
+                device_token, device_id, DELETE_BY_IDS_SQL, _valid_notification_ids(notification_ids)
+            )
+            deleted_count = len(deleted_result)
             
             # Log deletion (with consent check)
             metadata = {
@@ -767,7 +805,7 @@ async def delete_notifications(
                 "deleted_at": datetime.now(timezone.utc).isoformat()
             }
             
-            await privacy_analytics_service.track_action_with_consent(
+            analytics_service.track_action(
                 str(device_id),
                 'notifications_deleted',
                 metadata
@@ -799,8 +837,6 @@ async def get_active_devices_compatibility():
     Backward compatibility endpoint for GitHub Actions
     Redirects to the correct minimal-notifications endpoint
     """
-    from app.services.minimal_notification_service import MinimalNotificationService
-    
     try:
         service = MinimalNotificationService()
         devices = await service.get_active_devices_with_keywords()
@@ -834,8 +870,6 @@ async def process_notifications_compatibility(request: Dict[str, Any]):
     Backward compatibility endpoint for GitHub Actions notification processing
     Redirects to the correct minimal-notifications endpoint
     """
-    from app.services.minimal_notification_service import MinimalNotificationService
-    
     try:
         jobs = request.get("jobs", [])
         
@@ -851,37 +885,15 @@ async def process_notifications_compatibility(request: Dict[str, Any]):
                 }
             }
         
-        service = MinimalNotificationService()
-        
-        # Process each job
-        total_matches = 0
-        total_sent = 0
-        
-        for job in jobs:
-            try:
-                # Get active devices
-                devices = await service.get_active_devices_with_keywords()
-                
-                # Simple keyword matching
-                job_title = job.get("title", "").lower()
-                job_company = job.get("company", "").lower()
-                
-                for device in devices:
-                    # Check if any keywords match
-                    matched = False
-                    for keyword in device["keywords"]:
-                        if keyword.lower() in job_title or keyword.lower() in job_company:
-                            matched = True
-                            break
-                    
-                    if matched:
-                        total_matches += 1
-                        # In a real scenario, would send notification here
-                        total_sent += 1
-                        
-            except Exception as e:
-                logger.error(f"Error processing job: {e}")
-                continue
+        # Keyword matching runs in Postgres: one query counts (job, device) matches
+        # for the whole batch instead of re-reading every device once per job
+        total_matches = await db_manager.fetchval(
+            COMPAT_JOB_MATCH_COUNT_SQL,
+            [(job.get("title") or "").lower() for job in jobs],
+            [(job.get("company") or "").lower() for job in jobs]
+        )
+        # In a real scenario, would send notification here
+        total_sent = total_matches
         
         return {
             "success": True,
@@ -1086,18 +1098,12 @@ async def handle_notification_apply(
         if not job_hash:
             raise HTTPException(status_code=400, detail="job_hash is required")
         
-        # Get device info
-        device_query = """
-            SELECT id FROM iosapp.device_users
-            WHERE device_token = $1
-        """
-        device_result = await db_manager.execute_query(device_query, device_token)
+        # Get device_id (cached per token)
+        device_id = await db_manager.get_device_id(device_token)
         
-        if not device_result:
+        if device_id is None:
             raise HTTPException(status_code=404, detail="Device not found")
         
-        device_id = device_result[0]['id']
-        
         # Try to get the job by hash first
         job_lookup_result = await get_notification_job_by_hash(job_hash)
         
@@ -1108,8 +1114,6 @@ async def handle_notification_apply(
             # Mark notification as read if notification_id provided
             if notification_id:
                 try:
-                    import uuid
-                    
                     # Handle different notification ID formats
                     if str(notification_id).startswith('group_'):
                         # For grouped notifications, mark all notifications for this job_hash as read
@@ -1143,7 +1147,7 @@ async def handle_notification_apply(
                 "applied_at": datetime.now(timezone.utc).isoformat()
             }
             
-            await privacy_analytics_service.track_action_with_consent(
+            analytics_service.track_action(
                 str(device_id),
                 'job_apply_attempt',
                 metadata
@@ -1174,7 +1178,7 @@ async def handle_notification_apply(
                 "applied_at": datetime.now(timezone.utc).isoformat()
             }
             
-            await privacy_analytics_service.track_action_with_consent(
+            analytics_service.track_action(
                 str(device_id),
                 'job_apply_attempt',
                 metadata
@@ -1239,8 +1243,6 @@ async def get_job_matches_by_session_compat(
         logger.info(f"Job-matches session request: session_id={session_id}, page={page}, limit={limit}")
         
         # Try to extract device info from session_id pattern: match_YYYYMMDD_HHMMSS_devicetoken_suffix
-        import re
-        
         # Pattern: match_20250728_163244_1b04456c or similar
         session_pattern = r'^match_\d{8}_\d{6}_([a-fA-F0-9]+)$'
         match = re.match(session_pattern, session_id)
@@ -1283,7 +1285,7 @@ async def get_job_matches_by_session_compat(
                 # Get jobs for this session
                 jobs_query = """
                     SELECT job_hash, job_title, job_company, job_source, apply_link, 
-                           job_data, match_score, created_at
+                           job_data, match_score, created_at, COUNT(*) OVER () as total
                     FROM iosapp.job_match_session_jobs
                     WHERE session_id = $1
                     ORDER BY match_score DESC, created_at DESC
@@ -1292,14 +1294,13 @@ async def get_job_matches_by_session_compat(
                 
                 jobs_result = await db_manager.execute_query(jobs_query, session_id, limit, offset)
                 
-                # Get total count
-                count_query = """
-                    SELECT COUNT(*) as total
-                    FROM iosapp.job_match_session_jobs
-                    WHERE session_id = $1
-                """
-                count_result = await db_manager.execute_query(count_query, session_id)
-                total_count = count_result[0]['total'] if count_result else 0
+                # Total comes with the page; only a page past the end needs a separate count
+                if jobs_result:
+                    total_count = jobs_result[0]['total']
+                elif offset > 0:
+                    total_count = await db_manager.fetchval(SESSION_JOBS_COUNT_SQL, session_id)
+                else:
+                    total_count = 0
                 
                 logger.info(f"Session {session_id}: found {len(jobs_result)} jobs (total: {total_count})")
                 
@@ -1312,7 +1313,7 @@ async def get_job_matches_by_session_compat(
                 for job in jobs_result:
                     try:
                         # Parse job_data JSON
-                        job_data = json.loads(job['job_data']) if job['job_data'] else {}
+                        job_data = _json_value(job['job_data'], {})
                         
                         # Ensure all required fields are present with safe defaults
                         apply_link = job['apply_link'] or job_data.get('apply_link', '')
@@ -1354,7 +1355,7 @@ async def get_job_matches_by_session_compat(
                         "session": {
                             "session_id": session_data['session_id'],
                             "total_matches": session_data['total_matches'],
-                            "matched_keywords": json.loads(session_data['matched_keywords']) if session_data['matched_keywords'] else [],
+                            "matched_keywords": _json_value(session_data['matched_keywords'], []),
                             "created_at": session_data['created_at'].isoformat()
                         },
                         "jobs": jobs_data,
@@ -1396,7 +1397,6 @@ async def get_job_matches_by_session_compat(
 async def debug_hash_lookup(job_hash: str):
     """Debug endpoint for hash lookup issues"""
     try:
-        from app.services.minimal_notification_service import MinimalNotificationService
         notification_service = MinimalNotificationService()
         
         debug_info = {
@@ -1411,8 +1411,7 @@ async def debug_hash_lookup(job_hash: str):
         # Check database connectivity
         try:
             count_query = "SELECT COUNT(*) as count FROM scraper.jobs_jobpost"
-            count_result = await db_manager.execute_query(count_query)
-            jobs_count = count_result[0]['count'] if count_result else 0
+            jobs_count = await db_manager.fetchval(count_query)
             debug_info["jobs_available"] = jobs_count
             debug_info["database_status"] = "connected"
         except Exception as e:
@@ -1482,18 +1481,12 @@ async def get_job_matches_by_session(
         # Validate device token
         device_token = validate_device_token(device_token)
         
-        # Get device info
-        device_query = """
-            SELECT id FROM iosapp.device_users
-            WHERE device_token = $1
-        """
-        device_result = await db_manager.execute_query(device_query, device_token)
+        # Get device_id (cached per token)
+        device_id = await db_manager.get_device_id(device_token)
         
-        if not device_result:
+        if device_id is None:
             raise HTTPException(status_code=404, detail="Device not found")
         
-        device_id = str(device_result[0]['id'])
-        
         # If no session_id provided, get the latest session
         if not session_id:
             latest_session_query = """
@@ -1502,9 +1495,9 @@ async def get_job_matches_by_session(
                 ORDER BY created_at DESC
                 LIMIT 1
             """
-            session_result = await db_manager.execute_query(latest_session_query, device_id)
+            session_id = await db_manager.fetchval(latest_session_query, device_id)
             
-            if not session_result:
+            if session_id is None:
                 return {
                     "success": True,
                     "data": {
@@ -1519,8 +1512,6 @@ async def get_job_matches_by_session(
                     },
                     "message": "No job match sessions found"
                 }
-            
-            session_id = session_result[0]['session_id']
         
         # Get session details
         session_query = """
@@ -1528,17 +1519,15 @@ async def get_job_matches_by_session(
             FROM iosapp.job_match_sessions
             WHERE session_id = $1 AND device_id = $2
         """
-        session_result = await db_manager.execute_query(session_query, session_id, device_id)
+        session_data = await db_manager.fetchrow(session_query, session_id, device_id)
         
-        if not session_result:
+        if session_data is None:
             raise HTTPException(status_code=404, detail="Job match session not found")
         
-        session_data = session_result[0]
-        
         # Get paginated jobs from session
         jobs_query = """
             SELECT job_hash, job_title, job_company, job_source, apply_link, 
-                   job_data, match_score, created_at
+                   job_data, match_score, created_at, COUNT(*) OVER () as total
             FROM iosapp.job_match_session_jobs
             WHERE session_id = $1
             ORDER BY match_score DESC, created_at DESC
@@ -1547,21 +1536,20 @@ async def get_job_matches_by_session(
         
         jobs_result = await db_manager.execute_query(jobs_query, session_id, limit, offset)
         
-        # Get total count
-        count_query = """
-            SELECT COUNT(*) as total
-            FROM iosapp.job_match_session_jobs
-            WHERE session_id = $1
-        """
-        count_result = await db_manager.execute_query(count_query, session_id)
-        total_count = count_result[0]['total'] if count_result else 0
+        # Total comes with the page; only a page past the end needs a separate count
+        if jobs_result:
+            total_count = jobs_result[0]['total']
+        elif offset > 0:
+            total_count = await db_manager.fetchval(SESSION_JOBS_COUNT_SQL, session_id)
+        else:
+            total_count = 0
         
         # Format jobs data
         jobs_data = []
         for job in jobs_result:
             try:
                 # Parse job_data JSON
-                job_data = json.loads(job['job_data']) if job['job_data'] else {}
+                job_data = _json_value(job['job_data'], {})
                 
                 # Ensure all required fields are present with safe defaults
                 apply_link = job['apply_link'] or job_data.get('apply_link', '')
@@ -1594,7 +1582,7 @@ async def get_job_matches_by_session(
                 "session": {
                     "session_id": session_data['session_id'],
                     "total_matches": session_data['total_matches'],
-                    "matched_keywords": json.loads(session_data['matched_keywords']) if session_data['matched_keywords'] else [],
+                    "matched_keywords": _json_value(session_data['matched_keywords'], []),
                     "created_at": session_data['created_at'].isoformat()
                 },
                 "jobs": jobs_data,
@@ -3,19 +3,55 @@ Device-based minimal registration for iOS app
 Ultra-simple: device_token + keywords only
 """
 from fastapi import APIRouter, HTTPException, status
+from fastapi.responses import ORJSONResponse
 from typing import Dict, Any, List
 import logging
-import json
 import hashlib
 from datetime import datetime
 
-from app.core.database import db_manager
+from app.core.database import db_manager, DB_ERRORS
 from app.utils.validation import validate_device_token, validate_keywords
-from app.services.privacy_analytics_service import privacy_analytics_service
+from app.services.analytics_service import analytics_service
 
-router = APIRouter()
+router = APIRouter(default_response_class=ORJSONResponse)
 logger = logging.getLogger(__name__)
 
+# Device becomes user with last_activity tracking; the user profile row is created
+# alongside it, and the registration event is only written if the device has
+# analytics consent (same rule as privacy_analytics_service.track_action_with_consent)
+REGISTER_DEVICE_SQL = """
+    WITH device AS (
+        INSERT INTO iosapp.device_users (device_token, keywords, notifications_enabled, last_activity)
+        VALUES ($1, $2, true, NOW())
+        ON CONFLICT (device_token) 
+        DO UPDATE SET 
+            keywords = EXCLUDED.keywords,
+            notifications_enabled = true,
+            last_activity = NOW()
+        RETURNING id, created_at, analytics_consent
+    ), user_profile AS (
+        INSERT INTO iosapp.users (
+            device_id, 
+            job_matches_enabled,
+            application_reminders_enabled,
+            weekly_digest_enabled,
+            market_insights_enabled,
+            created_at,
+            updated_at
+        )
+        SELECT id, true, true, true, true, NOW(), NOW() FROM device
+        ON CONFLICT (device_id) 
+        DO UPDATE SET 
+            job_matches_enabled = EXCLUDED.job_matches_enabled,
+            updated_at = NOW()
+    ), registration_event AS (
+        INSERT INTO iosapp.user_analytics (device_id, action, metadata, created_at)
+        SELECT id, 'registration', $3::jsonb, NOW() FROM device
+        WHERE analytics_consent = true
+    )
+    SELECT id, created_at FROM device
+"""
+
 async def update_user_activity(device_token: str):
     """Update last_activity timestamp for a device"""
     try:
@@ -23,8 +59,8 @@ async def update_user_activity(device_token: str):
             "UPDATE iosapp.device_users SET last_activity = NOW() WHERE device_token = $1",
             device_token
         )
-    except Exception as e:
-        logger.warning(f"Failed to update last activity for device {device_token[:8]}...: {e}")
+    except DB_ERRORS as e:
+        logger.warning("Failed to update last activity for device %s...: %s", device_token[:8], e)
 
 @router.post("/register")
 async def register_device_minimal(request: Dict[str, Any]):
@@ -52,61 +88,11 @@ async def register_device_minimal(request: Dict[str, Any]):
                 logger.info(f"Legitimate validation error in device registration: {e.detail}")
             raise
         
-        # Single INSERT - device becomes user with last_activity tracking
-        insert_query = """
-            INSERT INTO iosapp.device_users (device_token, keywords, notifications_enabled, last_activity)
-            VALUES ($1, $2, true, NOW())
-            ON CONFLICT (device_token) 
-            DO UPDATE SET 
-                keywords = EXCLUDED.keywords,
-                notifications_enabled = true,
-                last_activity = NOW()
-            RETURNING id, created_at
-        """
-        
-        result = await db_manager.execute_query(
-            insert_query, 
-            device_token, 
-            json.dumps(keywords)
-        )
-        
-        if not result:
-            raise Exception("Failed to register device")
-        
-        device_id = result[0]['id']
-        created_at = result[0]['created_at']
-        
-        # Create user profile if it doesn't exist (using device_id as foreign key)
-        user_profile_query = """
-            INSERT INTO iosapp.users (
-                device_id, 
-                job_matches_enabled,
-                application_reminders_enabled,
-                weekly_digest_enabled,
-                market_insights_enabled,
-                created_at,
-                updated_at
-            )
-            VALUES ($1, true, true, true, true, NOW(), NOW())
-            ON CONFLICT (device_id) 
-            DO UPDATE SET 
-                job_matches_enabled = EXCLUDED.job_matches_enabled,
-                updated_at = NOW()
-            RETURNING id
-        """
-        
-        user_result = await db_manager.execute_query(
-            user_profile_query,
-            device_id
-        )
-        
-        if user_result:
-            logger.info(f"User profile created/updated for device {device_id}")
-        
-        # Record analytics (with consent check)
-        await privacy_analytics_service.track_action_with_consent(
-            str(device_id), 
-            'registration', 
+        # Device upsert, user profile and (consented) registration event in one round trip
+        result = await db_manager.fetchrow(
+            REGISTER_DEVICE_SQL,
+            device_token,
+            keywords,
             {
                 "keywords_count": len(keywords),
                 "keywords": keywords[:5],  # First 5 keywords for analytics
@@ -114,6 +100,13 @@ async def register_device_minimal(request: Dict[str, Any]):
             }
         )
         
+        if result is None:
+            raise HTTPException(status_code=500, detail="Registration failed: no row returned")
+        
+        device_id = result['id']
+        created_at = result['created_at']
+        db_manager.forget_device_profiles(device_token)
+        
         return {
             "success": True,
             "data": {
@@ -126,10 +119,8 @@ async def register_device_minimal(request: Dict[str, Any]):
             }
         }
         
-    except HTTPException:
-        raise
-    except Exception as e:
-        logger.error(f"Error in minimal device registration: {e}")
+    except DB_ERRORS as e:
+        logger.exception("Error in minimal device registration")
         raise HTTPException(status_code=500, detail=f"Registration failed: {str(e)}")
 
 @router.put("/keywords")
@@ -153,15 +144,15 @@ async def update_keywords(request: Dict[str, Any]):
             RETURNING id
         """
         
-        result = await db_manager.execute_query(update_query, json.dumps(keywords), device_token)
+        device_id = await db_manager.fetchval(update_query, keywords, device_token)
         
-        if not result:
+        if device_id is None:
             raise HTTPException(status_code=404, detail="Device not found")
         
-        device_id = result[0]['id']
+        db_manager.forget_device_profiles(device_token)
         
         # Record analytics (with consent check)
-        await privacy_analytics_service.track_action_with_consent(
+        analytics_service.track_action(
             str(device_id), 
             'keywords_update', 
             {
@@ -176,10 +167,8 @@ async def update_keywords(request: Dict[str, Any]):
             "keywords_count": len(keywords)
         }
         
-    except HTTPException:
-        raise
-    except Exception as e:
-        logger.error(f"Error updating keywords: {e}")
+    except DB_ERRORS as e:
+        logger.exception("Error updating keywords")
         raise HTTPException(status_code=500, detail=f"Failed to update keywords: {str(e)}")
 
 @router.get("/status/{device_token}")
@@ -194,16 +183,15 @@ async def get_device_status(device_token: str):
             WHERE device_token = $1
         """
         
-        result = await db_manager.execute_query(query, device_token)
+        device_data = await db_manager.fetchrow(query, device_token)
         
-        if not result:
+        if device_data is None:
             return {
                 "registered": False,
                 "message": "Device not found - registration required"
             }
         
-        device_data = result[0]
-        keywords = json.loads(device_data['keywords']) if device_data['keywords'] else []
+        keywords = device_data['keywords'] or []
         
         return {
             "registered": True,
@@ -218,10 +206,8 @@ async def get_device_status(device_token: str):
             "last_activity": device_data['last_activity'].isoformat() if device_data.get('last_activity') else None
         }
         
-    except HTTPException:
-        raise
-    except Exception as e:
-        logger.error(f"Error getting device status: {e}")
+    except DB_ERRORS as e:
+        logger.exception("Error getting device status")
         raise HTTPException(status_code=500, detail=f"Failed to get device status: {str(e)}")
 
 @router.post("/analytics/track")
@@ -235,33 +221,31 @@ async def track_user_action(request: Dict[str, Any]):
         if not device_token or not action:
             raise HTTPException(status_code=400, detail="device_token and action are required")
         
+        if not analytics_service.is_valid_action(action):
+            raise HTTPException(
+                status_code=400,
+                detail=f"action must be a string of at most {analytics_service.ACTION_MAX_LENGTH} characters"
+            )
+        
         device_token = validate_device_token(device_token)
         
-        # Get device_id
-        device_query = "SELECT id FROM iosapp.device_users WHERE device_token = $1"
-        device_result = await db_manager.execute_query(device_query, device_token)
+        # Get device_id (cached per token)
+        device_id = await db_manager.get_device_id(device_token)
         
-        if not device_result:
+        if device_id is None:
             raise HTTPException(status_code=404, detail="Device not found")
         
-        device_id = device_result[0]['id']
-        
         # Track action (with consent check)
-        await privacy_analytics_service.track_action_with_consent(
-            str(device_id), 
-            action, 
-            metadata
-        )
+        if not analytics_service.track_action(str(device_id), action, metadata):
+            raise HTTPException(status_code=503, detail="Action could not be recorded, try again later")
         
         return {
             "success": True,
             "message": f"Action '{action}' tracked successfully"
         }
         
-    except HTTPException:
-        raise
-    except Exception as e:
-        logger.error(f"Error tracking action: {e}")
+    except DB_ERRORS as e:
+        logger.exception("Error tracking action")
         raise HTTPException(status_code=500, detail=f"Failed to track action: {str(e)}")
 
 @router.get("/analytics/summary")
@@ -279,8 +263,8 @@ async def get_analytics_summary():
             }
         }
         
-    except Exception as e:
-        logger.error(f"Error getting analytics: {e}")
+    except DB_ERRORS as e:
+        logger.exception("Error getting analytics")
         raise HTTPException(status_code=500, detail=f"Failed to get analytics: {str(e)}")
 
 @router.delete("/device/{device_token}")
@@ -296,23 +280,31 @@ async def delete_device(device_token: str):
             RETURNING id
         """
         
-        result = await db_manager.execute_query(delete_query, device_token)
+        deleted_id = await db_manager.fetchval(delete_query, device_token)
         
-        if not result:
+        if deleted_id is None:
             raise HTTPException(status_code=404, detail="Device not found")
         
+        db_manager.forget_device_tokens(device_token)
+        
         return {
             "success": True,
             "message": "Device and all associated data deleted successfully",
-            "deleted_device_id": str(result[0]['id'])
+            "deleted_device_id": str(deleted_id)
         }
         
-    except HTTPException:
-        raise
-    except Exception as e:
-        logger.error(f"Error deleting device: {e}")
+    except DB_ERRORS as e:
+        logger.exception("Error deleting device")
         raise HTTPException(status_code=500, detail=f"Failed to delete device: {str(e)}")
 
+# activity_status label (from the CASE in get_users_activity) -> activity_summary key
+ACTIVITY_SUMMARY_KEYS = {
+    'Never active': "never_active",
+    'Active today': "active_today",
+    'Active this week': "active_this_week",
+    'Active this month': "active_this_month",
+}
+
 @router.get("/users-activity")
 async def get_users_activity():
     """Get all users with their last activity for admin tracking"""
@@ -352,16 +344,7 @@ async def get_users_activity():
         users_data = []
         for row in result:
             activity_status = row['activity_status']
-            if activity_status == 'Never active':
-                activity_summary["never_active"] += 1
-            elif activity_status == 'Active today':
-                activity_summary["active_today"] += 1
-            elif activity_status == 'Active this week':
-                activity_summary["active_this_week"] += 1
-            elif activity_status == 'Active this month':
-                activity_summary["active_this_month"] += 1
-            else:
-                activity_summary["inactive_30_plus"] += 1
+            activity_summary[ACTIVITY_SUMMARY_KEYS.get(activity_status, "inactive_30_plus")] += 1
             
             users_data.append({
                 "device_preview": row['device_preview'],
@@ -381,6 +364,6 @@ async def get_users_activity():
             "timestamp": datetime.now().isoformat()
         }
         
-    except Exception as e:
-        logger.error(f"Error getting users activity: {e}")
+    except DB_ERRORS as e:
+        logger.exception("Error getting users activity")
         raise HTTPException(status_code=500, detail=f"Failed to get users activity: {str(e)}")
\ No newline at end of file
@@ -1,4 +1,5 @@
 from fastapi import APIRouter, HTTPException, status
+from fastapi.responses import ORJSONResponse
 from typing import Dict, Any
 import logging
 from datetime import datetime, timezone
@@ -9,7 +10,7 @@ from app.core.redis_client import redis_client
 from app.core.config import settings
 from sqlalchemy import text
 
-router = APIRouter()
+router = APIRouter(default_response_class=ORJSONResponse)
 logger = logging.getLogger(__name__)
 
 @router.get("/status", response_model=Dict[str, Any])
@@ -42,11 +43,9 @@ async def health_check():
         # Check scraper health (check if there are recent jobs)
         scraper_healthy = True
         try:
-            recent_jobs = await db_manager.execute_query(
-                "SELECT COUNT(*) as count FROM scraper.jobs_jobpost WHERE created_at > NOW() - INTERVAL '8 hours'"
+            scraper_healthy = await db_manager.fetchval(
+                "SELECT EXISTS (SELECT 1 FROM scraper.jobs_jobpost WHERE created_at > NOW() - INTERVAL '8 hours')"
             )
-            if recent_jobs and recent_jobs[0]['count'] == 0:
-                scraper_healthy = False
         except Exception as e:
             logger.error(f"Scraper health check failed: {e}")
             scraper_healthy = False
@@ -290,6 +289,225 @@ async def fix_privacy_policy_version_length():
             "timestamp": datetime.now(timezone.utc).isoformat()
         }
 
+@router.post("/create-user-stats-rollup")
+async def create_user_stats_rollup():
+    """Create daily rollup tables (kept current by triggers) backing /users/stats"""
+    try:
+        ddl_queries = [
+            """
+            CREATE TABLE IF NOT EXISTS iosapp.user_stats_daily (
+                device_id UUID NOT NULL REFERENCES iosapp.device_users(id) ON DELETE CASCADE,
+                day DATE NOT NULL,
+                action VARCHAR(100) NOT NULL,
+                count BIGINT NOT NULL DEFAULT 0,
+                last_at TIMESTAMP WITH TIME ZONE,
+                PRIMARY KEY (device_id, day, action)
+            );
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS iosapp.notification_hashes_daily (
+                device_id UUID NOT NULL REFERENCES iosapp.device_users(id) ON DELETE CASCADE,
+                day DATE NOT NULL,
+                job_source VARCHAR(100) NOT NULL,
+                count BIGINT NOT NULL DEFAULT 0,
+                PRIMARY KEY (device_id, day, job_source)
+            );
+            """,
+            """
+            CREATE OR REPLACE FUNCTION iosapp.user_stats_daily_ins() RETURNS trigger AS $$
+            BEGIN
+                INSERT INTO iosapp.user_stats_daily AS s (device_id, day, action, count, last_at)
+                SELECT device_id, created_at::date, action, COUNT(*), MAX(created_at)
+                FROM new_rows
+                GROUP BY 1, 2, 3
+                ON CONFLICT (device_id, day, action) DO UPDATE
+                SET count = s.count + EXCLUDED.count,
+                    last_at = GREATEST(s.last_at, EXCLUDED.last_at);
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql;
+            """,
+            """
+            CREATE OR REPLACE FUNCTION iosapp.user_stats_daily_del() RETURNS trigger AS $$
+            BEGIN
+                UPDATE iosapp.user_stats_daily s
+                SET count = s.count - o.n
+                FROM (
+                    SELECT device_id, created_at::date AS day, action, COUNT(*) AS n
+                    FROM old_rows
+                    GROUP BY 1, 2, 3
+                ) o
+                WHERE s.device_id = o.device_id AND s.day = o.day AND s.action = o.action;
+                DELETE FROM iosapp.user_stats_daily s
+                USING (SELECT DISTINCT device_id FROM old_rows) o
+                WHERE s.device_id = o.device_id AND s.count <= 0;
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql;
+            """,
+            """
+            CREATE OR REPLACE FUNCTION iosapp.notification_hashes_daily_ins() RETURNS trigger AS $$
+            BEGIN
+                INSERT INTO iosapp.notification_hashes_daily AS s (device_id, day, job_source, count)
+                SELECT device_id, sent_at::date, COALESCE(job_source, ''), COUNT(*)
+                FROM new_rows
+                GROUP BY 1, 2, 3
+                ON CONFLICT (device_id, day, job_source) DO UPDATE
+                SET count = s.count + EXCLUDED.count;
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql;
+            """,
+            """
+            CREATE OR REPLACE FUNCTION iosapp.notification_hashes_daily_del() RETURNS trigger AS $$
+            BEGIN
+                UPDATE iosapp.notification_hashes_daily s
+                SET count = s.count - o.n
+                FROM (
+                    SELECT device_id, sent_at::date AS day, COALESCE(job_source, '') AS job_source, COUNT(*) AS n
+                    FROM old_rows
+                    GROUP BY 1, 2, 3
+                ) o
+                WHERE s.device_id = o.device_id AND s.day = o.day AND s.job_source = o.job_source;
+                DELETE FROM iosapp.notification_hashes_daily s
+                USING (SELECT DISTINCT device_id FROM old_rows) o
+                WHERE s.device_id = o.device_id AND s.count <= 0;
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql;
+            """,
+            "DROP TRIGGER IF EXISTS user_stats_daily_ins ON iosapp.user_analytics;",
+            """
+            CREATE TRIGGER user_stats_daily_ins AFTER INSERT ON iosapp.user_analytics
+            REFERENCING NEW TABLE AS new_rows
+            FOR EACH STATEMENT EXECUTE PROCEDURE iosapp.user_stats_daily_ins();
+            """,
+            "DROP TRIGGER IF EXISTS user_stats_daily_del ON iosapp.user_analytics;",
+            """
+            CREATE TRIGGER user_stats_daily_del AFTER DELETE ON iosapp.user_analytics
+            REFERENCING OLD TABLE AS old_rows
+            FOR EACH STATEMENT EXECUTE PROCEDURE iosapp.user_stats_daily_del();
+            """,
+            "DROP TRIGGER IF EXISTS notification_hashes_daily_ins ON iosapp.notification_hashes;",
+            """
+            CREATE TRIGGER notification_hashes_daily_ins AFTER INSERT ON iosapp.notification_hashes
+            REFERENCING NEW TABLE AS new_rows
+            FOR EACH STATEMENT EXECUTE PROCEDURE iosapp.notification_hashes_daily_ins();
+            """,
+            "DROP TRIGGER IF EXISTS notification_hashes_daily_del ON iosapp.notification_hashes;",
+            """
+            CREATE TRIGGER notification_hashes_daily_del AFTER DELETE ON iosapp.notification_hashes
+            REFERENCING OLD TABLE AS old_rows
+            FOR EACH STATEMENT EXECUTE PROCEDURE iosapp.notification_hashes_daily_del();
+            """
+        ]
+        
+        # Backfill from history while writers are blocked so no row is counted twice or missed
+        backfill_queries = [
+            "LOCK TABLE iosapp.user_analytics, iosapp.notification_hashes IN SHARE MODE;",
+            "TRUNCATE iosapp.user_stats_daily, iosapp.notification_hashes_daily;",
+            """
+            INSERT INTO iosapp.user_stats_daily (device_id, day, action, count, last_at)
+            SELECT device_id, created_at::date, action, COUNT(*), MAX(created_at)
+            FROM iosapp.user_analytics
+            GROUP BY 1, 2, 3;
+            """,
+            """
+            INSERT INTO iosapp.notification_hashes_daily (device_id, day, job_source, count)
+            SELECT device_id, sent_at::date, COALESCE(job_source, ''), COUNT(*)
+            FROM iosapp.notification_hashes
+            GROUP BY 1, 2, 3;
+            """
+        ]
+        
+        async with db_manager.connection() as conn:
+            async with conn.transaction():
+                for query in ddl_queries + backfill_queries:
+                    await conn.execute(query)
+        
+        return {
+            "success": True,
+            "message": "User stats rollup tables created and backfilled",
+            "tables": ["iosapp.user_stats_daily", "iosapp.notification_hashes_daily"],
+            "timestamp": datetime.now(timezone.utc).isoformat()
+        }
+        
+    except Exception as e:
+        logger.error(f"Error creating user stats rollup: {e}")
+        return {
+            "success": False,
+            "message": f"Failed to create rollup: {str(e)}",
+            "timestamp": datetime.now(timezone.utc).isoformat()
+        }
+
+@router.post("/add-analytics-indexes")
+async def add_analytics_indexes():
+    """Add (device_id, time DESC) and per-session indexes for the per-device analytics, notification and job-match reads,
+    plus time-only indexes for the paginated job listing and the all-device windows (stats, cleanup)"""
+    try:
+        # CONCURRENTLY avoids blocking writers; it cannot run inside a transaction block
+        index_queries = [
+            """
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_ua_device_created_action
+            ON iosapp.user_analytics (device_id, created_at DESC) INCLUDE (action, metadata);
+            """,
+            """
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_nh_device_sent
+            ON iosapp.notification_hashes (device_id, sent_at DESC) INCLUDE (job_source);
+            """,
+            """
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_nh_device_unread
+            ON iosapp.notification_hashes (device_id) WHERE is_read = false;
+            """,
+            """
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_jms_device_sent_created
+            ON iosapp.job_match_sessions (device_id, created_at DESC) WHERE notification_sent = true;
+            """,
+            """
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_jmsj_session_score
+            ON iosapp.job_match_session_jobs (session_id, match_score DESC, created_at DESC);
+            """,
+            """
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_jobs_created_at
+            ON scraper.jobs_jobpost (created_at DESC);
+            """,
+            """
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_nh_sent_at
+            ON iosapp.notification_hashes (sent_at);
+            """,
+            """
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_ua_created_at
+            ON iosapp.user_analytics (created_at);
+            """
+        ]
+        
+        for query in index_queries:
+            await db_manager.execute_command(query)
+        
+        return {
+            "success": True,
+            "message": "Analytics indexes created successfully",
+            "indexes_added": [
+                "idx_ua_device_created_action ON user_analytics (device_id, created_at DESC) INCLUDE (action, metadata)",
+                "idx_nh_device_sent ON notification_hashes (device_id, sent_at DESC) INCLUDE (job_source)",
+                "idx_nh_device_unread ON notification_hashes (device_id) WHERE is_read = false",
+                "idx_jms_device_sent_created ON job_match_sessions (device_id, created_at DESC) WHERE notification_sent = true",
+                "idx_jmsj_session_score ON job_match_session_jobs (session_id, match_score DESC, created_at DESC)",
+                "idx_jobs_created_at ON scraper.jobs_jobpost (created_at DESC)",
+                "idx_nh_sent_at ON notification_hashes (sent_at)",
+                "idx_ua_created_at ON user_analytics (created_at)"
+            ],
+            "timestamp": datetime.now(timezone.utc).isoformat()
+        }
+        
+    except Exception as e:
+        logger.error(f"Error adding analytics indexes: {e}")
+        return {
+            "success": False,
+            "message": f"Failed to add indexes: {str(e)}",
+            "timestamp": datetime.now(timezone.utc).isoformat()
+        }
+
 @router.get("/db-debug")
 async def debug_database_connection():
     """Debug database connection issues with detailed information"""
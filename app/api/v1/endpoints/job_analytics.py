@@ -2,41 +2,77 @@
 Job Market Analytics Endpoints
 Real-time insights from scraped job data (current snapshot)
 """
-from fastapi import APIRouter, Query, HTTPException
+from fastapi import APIRouter, Query, HTTPException, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import ORJSONResponse
 from typing import Dict, Any
 from datetime import datetime
+from collections import defaultdict
+from cachetools import TTLCache
+import asyncio
+import functools
 import logging
+import orjson
+import uuid
 
 from app.core.database import db_manager
+from app.services.analytics_service import analytics_service
 
-router = APIRouter()
+router = APIRouter(default_response_class=ORJSONResponse)
 logger = logging.getLogger(__name__)
 
+# jobs_jobpost is truncated and reloaded hourly - keep each full-table aggregation's
+# serialized response for a few minutes per endpoint and query parameters
+_snapshot_cache: TTLCache = TTLCache(maxsize=256, ttl=300)
+_snapshot_locks: Dict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
+
+def cached_snapshot(handler):
+    """Serve an analytics handler from _snapshot_cache; only successful responses are kept"""
+    @functools.wraps(handler)
+    async def wrapper(**kwargs):
+        key = (handler.__name__, *sorted(kwargs.items()))
+        body = _snapshot_cache.get(key)
+        if body is None:
+            # Single-flight per endpoint: concurrent misses wait for one aggregation
+            async with _snapshot_locks[handler.__name__]:
+                body = _snapshot_cache.get(key)
+                if body is None:
+                    result = await handler(**kwargs)
+                    body = orjson.dumps(jsonable_encoder(result))
+                    if result.get("success"):
+                        _snapshot_cache[key] = body
+        return Response(content=body, media_type="application/json")
+    return wrapper
+
 @router.get("/market-overview")
+@cached_snapshot
 async def get_market_overview():
     """
     Get high-level job market overview
     Real-time snapshot of current job market state
     """
     try:
-        # Basic market metrics
-        queries = {
-            "total_jobs": "SELECT COUNT(*) as count FROM scraper.jobs_jobpost",
-            "unique_companies": "SELECT COUNT(DISTINCT company) as count FROM scraper.jobs_jobpost",
-            "unique_sources": "SELECT COUNT(DISTINCT source) as count FROM scraper.jobs_jobpost",
-            "data_freshness": "SELECT MIN(created_at) as oldest, MAX(created_at) as newest FROM scraper.jobs_jobpost"
-        }
+        # Basic market metrics - one pass over the table, one round-trip
+        overview_query = """
+            SELECT COUNT(*) as total_jobs,
+                   COUNT(DISTINCT company) as unique_companies,
+                   COUNT(DISTINCT source) as unique_sources,
+                   MIN(created_at) as oldest,
+                   MAX(created_at) as newest
+            FROM scraper.jobs_jobpost
+        """
         
-        results = {}
-        for key, query in queries.items():
-            result = await db_manager.execute_query(query)
-            if key == "data_freshness":
-                results[key] = {
-                    "oldest": result[0]["oldest"].isoformat() if result[0]["oldest"] else None,
-                    "newest": result[0]["newest"].isoformat() if result[0]["newest"] else None
-                }
-            else:
-                results[key] = result[0]["count"] if result else 0
+        overview = await db_manager.fetchrow(overview_query)
+        
+        results = {
+            "total_jobs": overview["total_jobs"],
+            "unique_companies": overview["unique_companies"],
+            "unique_sources": overview["unique_sources"],
+            "data_freshness": {
+                "oldest": overview["oldest"].isoformat() if overview["oldest"] else None,
+                "newest": overview["newest"].isoformat() if overview["newest"] else None
+            }
+        }
         
         return {
             "success": True,
@@ -50,6 +86,7 @@ async def get_market_overview():
         raise HTTPException(status_code=500, detail="Failed to get market overview")
 
 @router.get("/source-analytics")
+@cached_snapshot
 async def get_source_analytics():
     """
     Analyze job volume and distribution by source
@@ -99,6 +136,7 @@ async def get_source_analytics():
         raise HTTPException(status_code=500, detail="Failed to get source analytics")
 
 @router.get("/company-analytics")
+@cached_snapshot
 async def get_company_analytics(
     limit: int = Query(default=20, ge=1, le=100, description="Number of companies to return")
 ):
@@ -162,6 +200,7 @@ async def get_company_analytics(
         raise HTTPException(status_code=500, detail="Failed to get company analytics")
 
 @router.get("/title-analytics")
+@cached_snapshot
 async def get_title_analytics(
     limit: int = Query(default=30, ge=1, le=100, description="Number of titles to return")
 ):
@@ -243,6 +282,7 @@ async def get_title_analytics(
         raise HTTPException(status_code=500, detail="Failed to get title analytics")
 
 @router.get("/keyword-trends")
+@cached_snapshot
 async def get_keyword_trends():
     """
     Analyze trending keywords and skills in job titles
@@ -331,6 +371,7 @@ async def get_keyword_trends():
         raise HTTPException(status_code=500, detail="Failed to get keyword trends")
 
 @router.get("/remote-work-analysis")
+@cached_snapshot
 async def get_remote_work_analysis():
     """
     Analyze remote work opportunities based on title keywords
@@ -389,6 +430,7 @@ async def get_remote_work_analysis():
         raise HTTPException(status_code=500, detail="Failed to get remote work analysis")
 
 @router.get("/market-competition")
+@cached_snapshot
 async def get_market_competition():
     """
     Analyze market competition and job scarcity
@@ -479,6 +521,7 @@ async def get_market_competition():
         raise HTTPException(status_code=500, detail="Failed to get market competition analysis")
 
 @router.get("/snapshot-summary")
+@cached_snapshot
 async def get_snapshot_summary():
     """
     Get comprehensive market snapshot summary
@@ -560,8 +603,19 @@ async def track_analytics_event(request: Dict[str, Any]):
         if not device_id or not action_type:
             raise HTTPException(status_code=400, detail="device_id and action_type are required")
         
-        # Track the event using privacy analytics service
-        from app.services.privacy_analytics_service import privacy_analytics_service
+        try:
+            device_id = str(uuid.UUID(str(device_id)))
+        except ValueError:
+            raise HTTPException(status_code=400, detail="device_id must be a UUID")
+        
+        if not analytics_service.is_valid_action(action_type):
+            raise HTTPException(
+                status_code=400,
+                detail=f"action_type must be a string of at most {analytics_service.ACTION_MAX_LENGTH} characters"
+            )
+        
+        if not isinstance(action_data, dict):
+            raise HTTPException(status_code=400, detail="action_data must be an object")
         
         # Map action types to analytics actions
         analytics_action = {
@@ -580,11 +634,8 @@ async def track_analytics_event(request: Dict[str, Any]):
         }
         
         # Track with consent check
-        await privacy_analytics_service.track_action_with_consent(
-            device_id,
-            analytics_action,
-            metadata
-        )
+        if not analytics_service.track_action(device_id, analytics_action, metadata):
+            raise HTTPException(status_code=503, detail="Event could not be recorded, try again later")
         
         logger.info(f"Tracked analytics event: {action_type} for device {device_id[:8]}...")
         
@@ -1,13 +1,33 @@
 from fastapi import APIRouter, Query, HTTPException, status
+from fastapi.responses import ORJSONResponse
 from typing import Optional, List, Dict, Any
 from datetime import datetime, timedelta
 import logging
 
-from app.core.database import db_manager
+from app.core.database import db_manager, DB_ERRORS
 
-router = APIRouter()
+router = APIRouter(default_response_class=ORJSONResponse)
 logger = logging.getLogger(__name__)
 
+# Listing/detail projection with the response defaults applied in SQL, so each
+# row maps straight onto JOB_FIELDS without per-column Python fallbacks
+JOB_SELECT_COLUMNS = """
+    j.id,
+    COALESCE(NULLIF(j.title, ''), 'No Title') as title,
+    COALESCE(NULLIF(j.company, ''), 'Unknown Company') as company,
+    COALESCE(j.apply_link, '') as apply_link,
+    COALESCE(NULLIF(j.source, ''), 'Unknown') as source,
+    j.created_at as posted_at
+"""
+JOB_FIELDS = ("id", "title", "company", "apply_link", "source", "posted_at")
+
+# Planner row estimate for the whole table: constant time, refreshed by ANALYZE/autovacuum
+JOBS_ESTIMATE_SQL = """
+    SELECT GREATEST(reltuples, 0)::bigint
+    FROM pg_class
+    WHERE oid = 'scraper.jobs_jobpost'::regclass
+"""
+
 @router.get("/", response_model=Dict[str, Any])
 async def get_jobs(
     limit: int = Query(default=20, ge=1, le=100, description="Number of jobs to return"),
@@ -18,7 +38,8 @@ async def get_jobs(
     location: Optional[str] = Query(default=None, description="Filter by location"),
     days: Optional[int] = Query(default=None, ge=1, le=365, description="Jobs posted within last N days"),
     sort_by: str = Query(default="created_at", description="Sort by: created_at, title, company"),
-    sort_order: str = Query(default="desc", regex="^(asc|desc)$", description="Sort order: asc or desc")
+    sort_order: str = Query(default="desc", regex="^(asc|desc)$", description="Sort order: asc or desc"),
+    exact: bool = Query(default=True, description="Exact total; false allows a planner estimate for unfiltered listings")
 ):
     """
     Get jobs from the scraper database with filtering, search, and pagination.
@@ -82,7 +103,7 @@ async def get_jobs(
             sort_order_str = "DESC"
         
         # Build ORDER BY clause
-        order_clause = f"ORDER BY {sort_by} {sort_order_str}"
+        order_clause = f"ORDER BY j.{sort_by} {sort_order_str}"
         
         # Build LIMIT and OFFSET
         param_count += 1
@@ -95,14 +116,9 @@ async def get_jobs(
         
         # Build final query
         jobs_query = f"""
-            SELECT 
-                id,
-                title,
-                company,
-                apply_link,
-                source,
-                created_at as posted_at
-            FROM scraper.jobs_jobpost
+            SELECT {JOB_SELECT_COLUMNS},
+                COUNT(*) OVER () as total
+            FROM scraper.jobs_jobpost j
             {where_clause}
             {order_clause}
             {limit_offset_clause}
@@ -111,29 +127,24 @@ async def get_jobs(
         # Get jobs
         jobs_result = await db_manager.execute_query(jobs_query, *params)
         
-        # Get total count for pagination
-        count_params = params[:-2]  # Remove limit and offset
-        count_query = f"""
-            SELECT COUNT(*) as total
-            FROM scraper.jobs_jobpost
-            {where_clause}
-        """
+        # Total comes with the page; only a page past the end needs a separate count
+        if not where_conditions and not exact:
+            total_count = await db_manager.fetchval(JOBS_ESTIMATE_SQL)
+        elif jobs_result:
+            total_count = jobs_result[0]['total']
+        elif offset > 0:
+            count_params = params[:-2]  # Remove limit and offset
+            count_query = f"""
+                SELECT COUNT(*) as total
+                FROM scraper.jobs_jobpost
+                {where_clause}
+            """
+            total_count = await db_manager.fetchval(count_query, *count_params)
+        else:
+            total_count = 0
         
-        count_result = await db_manager.execute_query(count_query, *count_params)
-        total_count = count_result[0]['total'] if count_result else 0
-        
-        # Format jobs data
-        jobs_data = []
-        for job in jobs_result:
-            job_item = {
-                "id": job['id'],
-                "title": job['title'] or "No Title",
-                "company": job['company'] or "Unknown Company",
-                "apply_link": job['apply_link'] or "",
-                "source": job['source'] or "Unknown",
-                "posted_at": job['posted_at'].isoformat() if job['posted_at'] else None
-            }
-            jobs_data.append(job_item)
+        # Format jobs data (zip stops before the trailing window total)
+        jobs_data = [dict(zip(JOB_FIELDS, job)) for job in jobs_result]
         
         # Calculate pagination info
         total_pages = (total_count + limit - 1) // limit
@@ -141,7 +152,7 @@ async def get_jobs(
         has_more = offset + limit < total_count
         has_previous = offset > 0
         
-        return {
+        return ORJSONResponse({
             "success": True,
             "data": {
                 "jobs": jobs_data,
@@ -164,10 +175,10 @@ async def get_jobs(
                     "sort_order": sort_order
                 }
             }
-        }
+        })
         
-    except Exception as e:
-        logger.error(f"Error getting jobs: {e}")
+    except DB_ERRORS:
+        logger.exception("Error getting jobs")
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Failed to get jobs"
@@ -177,45 +188,27 @@ async def get_jobs(
 async def get_job_by_id(job_id: int):
     """Get a specific job by ID"""
     try:
-        job_query = """
-            SELECT 
-                id,
-                title,
-                company,
-                apply_link,
-                source,
-                created_at as posted_at
-            FROM scraper.jobs_jobpost
-            WHERE id = $1
+        job_query = f"""
+            SELECT {JOB_SELECT_COLUMNS}
+            FROM scraper.jobs_jobpost j
+            WHERE j.id = $1
         """
         
-        job_result = await db_manager.execute_query(job_query, job_id)
+        job = await db_manager.fetchrow(job_query, job_id)
         
-        if not job_result:
+        if job is None:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail="Job not found"
             )
         
-        job = job_result[0]
-        job_data = {
-            "id": job['id'],
-            "title": job['title'] or "No Title",
-            "company": job['company'] or "Unknown Company", 
-            "apply_link": job['apply_link'] or "",
-            "source": job['source'] or "Unknown",
-            "posted_at": job['posted_at'].isoformat() if job['posted_at'] else None
-        }
-        
-        return {
+        return ORJSONResponse({
             "success": True,
-            "data": job_data
-        }
+            "data": dict(zip(JOB_FIELDS, job))
+        })
         
-    except HTTPException:
-        raise
-    except Exception as e:
-        logger.error(f"Error getting job {job_id}: {e}")
+    except DB_ERRORS:
+        logger.exception("Error getting job %s", job_id)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Failed to get job"
@@ -225,7 +218,7 @@ async def get_job_by_id(job_id: int):
 async def get_job_by_hash(job_hash: str):
     """Get a specific job by hash (for persistent notification references)"""
     try:
-        # First, try to find the job by hash using title and company
+        # Find the job by hash using title and company
         # This works even after truncate-and-load operations
         job_query = """
             SELECT 
@@ -242,40 +235,14 @@ async def get_job_by_hash(job_hash: str):
         """
         
         # Try to find by hash match
-        job_result = await db_manager.execute_query(job_query, job_hash)
-        
-        if not job_result:
-            # If not found by hash, try alternative search by comparing all jobs
-            fallback_query = """
-                SELECT 
-                    id,
-                    title,
-                    company,
-                    apply_link,
-                    source,
-                    created_at as posted_at,
-                    LEFT(ENCODE(SHA256(CONVERT_TO(LOWER(TRIM(title)) || '|' || LOWER(TRIM(company)), 'UTF8')), 'hex'), 32) as computed_hash
-                FROM scraper.jobs_jobpost
-                WHERE created_at >= NOW() - INTERVAL '30 days'
-                ORDER BY created_at DESC
-                LIMIT 500
-            """
-            
-            all_jobs = await db_manager.execute_query(fallback_query)
-            
-            # Find matching job by hash
-            for job in all_jobs:
-                if job.get('computed_hash') == job_hash:
-                    job_result = [job]
-                    break
+        job = await db_manager.fetchrow(job_query, job_hash)
         
-        if not job_result:
+        if job is None:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail="Job not found by hash. This may happen if the job is older than 30 days or has been removed."
             )
         
-        job = job_result[0]
         job_data = {
             "id": job['id'],
             "title": job['title'] or "No Title",
@@ -292,10 +259,8 @@ async def get_job_by_hash(job_hash: str):
             "data": job_data
         }
         
-    except HTTPException:
-        raise
-    except Exception as e:
-        logger.error(f"Error getting job by hash {job_hash}: {e}")
+    except DB_ERRORS:
+        logger.exception("Error getting job by hash %s", job_hash)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Failed to get job by hash"
@@ -334,8 +299,8 @@ async def get_job_sources():
             }
         }
         
-    except Exception as e:
-        logger.error(f"Error getting job sources: {e}")
+    except DB_ERRORS:
+        logger.exception("Error getting job sources")
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Failed to get job sources"
@@ -381,8 +346,8 @@ async def get_job_stats():
                 }
             }
         
-    except Exception as e:
-        logger.error(f"Error getting job stats: {e}")
+    except DB_ERRORS:
+        logger.exception("Error getting job stats")
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Failed to get job statistics"
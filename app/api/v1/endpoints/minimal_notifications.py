@@ -3,6 +3,7 @@ Minimal notification endpoints for device-based system
 Hash-based deduplication for scraped jobs
 """
 from fastapi import APIRouter, HTTPException, BackgroundTasks
+from fastapi.responses import ORJSONResponse
 from typing import Dict, Any, List, Optional
 import logging
 import asyncio
@@ -10,8 +11,9 @@ from datetime import datetime
 
 from app.core.database import db_manager
 from app.services.minimal_notification_service import minimal_notification_service
+from app.utils.validation import validate_device_token
 
-router = APIRouter()
+router = APIRouter(default_response_class=ORJSONResponse)
 logger = logging.getLogger(__name__)
 
 @router.post("/process-all")
@@ -220,7 +222,6 @@ async def get_notification_statistics():
 async def test_device_notification(device_token: str):
     """Send test notification to specific device"""
     try:
-        from app.utils.validation import validate_device_token
         device_token = validate_device_token(device_token)
         
         # Get device info
@@ -228,13 +229,13 @@ async def test_device_notification(device_token: str):
             SELECT id, keywords FROM iosapp.device_users
             WHERE device_token = $1 AND notifications_enabled = true
         """
-        device_result = await db_manager.execute_query(device_query, device_token)
+        device = await db_manager.fetchrow(device_query, device_token)
         
-        if not device_result:
+        if device is None:
             raise HTTPException(status_code=404, detail="Device not found or notifications disabled")
         
-        device_id = str(device_result[0]['id'])
-        keywords = device_result[0]['keywords']
+        device_id = str(device['id'])
+        keywords = device['keywords']
         
         # Create test job
         test_job = {
@@ -2,9 +2,14 @@
 Privacy management endpoints for GDPR/CCPA compliance
 Allows users to manage their analytics consent and data
 """
-from fastapi import APIRouter, HTTPException, status
-from typing import Dict, Any, Optional
+from fastapi import APIRouter, HTTPException, Request, Response, status
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from typing import Dict, Any, Optional, AsyncIterator
+import asyncio
+import hashlib
 import logging
+import orjson
+from cachetools import TTLCache
 from datetime import datetime, timezone
 from pydantic import BaseModel
 
@@ -12,7 +17,8 @@ from app.core.database import db_manager
 from app.utils.validation import validate_device_token
 from app.services.privacy_analytics_service import privacy_analytics_service
 
-router = APIRouter()
+# orjson serializes datetimes natively, so handlers return them as-is
+router = APIRouter(default_response_class=ORJSONResponse)
 logger = logging.getLogger(__name__)
 
 # Pydantic models
@@ -29,36 +35,86 @@ class DataExportRequest(BaseModel):
     device_token: str
     email: Optional[str] = None  # Optional email for sending export
 
+# Static response fragments - built once at import instead of per request
+_STATUS_RIGHTS = {
+    "consent": "You can grant or revoke analytics consent at any time",
+    "access": "You can request a copy of your data",
+    "deletion": "You can request deletion of your data",
+    "portability": "You can export your data in JSON format"
+}
+
+_PRIVACY_POLICY = {
+    "success": True,
+    "data": {
+        "privacy_policy": {
+            "version": "1.0",
+            "effective_date": "2025-07-13",
+            "last_updated": "2025-07-13"
+        },
+        "data_collection": [
+            "Device registration information",
+            "Job search keywords and preferences", 
+            "App usage analytics (with consent)",
+            "Notification interaction data (with consent)"
+        ],
+        "data_usage": [
+            "To provide job notification services",
+            "To improve app functionality (with consent)", 
+            "To generate anonymous usage statistics"
+        ],
+        "data_retention": "Analytics data is kept while consent is active. Registration data is kept until account deletion.",
+        "your_rights": {
+            "consent": "Grant or revoke analytics consent at any time",
+            "access": "Request a copy of your personal data",
+            "deletion": "Request deletion of your personal data",
+            "portability": "Export your data in machine-readable format",
+            "objection": "Object to processing of your data"
+        },
+        "contact": {
+            "data_protection": "privacy@yourapp.com",
+            "support": "support@yourapp.com"
+        },
+        "legal_basis": {
+            "service_provision": "Contract performance (job notifications)",
+            "analytics": "Explicit consent",
+            "legitimate_interest": "Anonymous app improvement"
+        }
+    }
+}
+
+_POLICY_BYTES = orjson.dumps(_PRIVACY_POLICY)
+# Weak validator: GZipMiddleware may send these bytes compressed under the same tag
+_POLICY_ETAG_OPAQUE = f'"{hashlib.sha256(_POLICY_BYTES).hexdigest()}"'
+_POLICY_ETAG = f'W/{_POLICY_ETAG_OPAQUE}'
+_POLICY_HEADERS = {"ETag": _POLICY_ETAG, "Cache-Control": "public, max-age=3600"}
+
+# Anonymous aggregates change slowly - keep the serialized response for a minute
+_ANONYMOUS_CACHE_KEY = "anonymous_summary"
+_anonymous_cache: TTLCache = TTLCache(maxsize=1, ttl=60)
+_anonymous_lock = asyncio.Lock()
+
 @router.get("/status/{device_token}")
 async def get_privacy_status(device_token: str):
     """Get user's current privacy and consent status"""
     try:
         device_token = validate_device_token(device_token)
         
-        # Get device and privacy info
+        # Get device, privacy info and analytics count (only counted if user has consented)
         query = """
             SELECT id, analytics_consent, consent_date, privacy_policy_version, 
-                   notifications_enabled, created_at
-            FROM iosapp.device_users 
+                   notifications_enabled, created_at,
+                   CASE WHEN analytics_consent THEN (
+                       SELECT COUNT(*) FROM iosapp.user_analytics WHERE device_id = d.id
+                   ) ELSE 0 END AS analytics_count
+            FROM iosapp.device_users d
             WHERE device_token = $1
         """
-        result = await db_manager.execute_query(query, device_token)
+        device = await db_manager.fetchrow(query, device_token)
         
-        if not result:
+        if not device:
             raise HTTPException(status_code=404, detail="Device not found")
         
-        device = result[0]
-        
-        # Get analytics data count if user has consented
-        analytics_count = 0
-        if device['analytics_consent']:
-            count_query = """
-                SELECT COUNT(*) as count 
-                FROM iosapp.user_analytics 
-                WHERE device_id = $1
-            """
-            count_result = await db_manager.execute_query(count_query, device['id'])
-            analytics_count = count_result[0]['count'] if count_result else 0
+        analytics_count = device['analytics_count']
         
         return {
             "success": True,
@@ -67,21 +123,16 @@ async def get_privacy_status(device_token: str):
                 "device_token_preview": device_token[:16] + "...",
                 "privacy_status": {
                     "analytics_consent": device['analytics_consent'],
-                    "consent_date": device['consent_date'].isoformat() if device['consent_date'] else None,
+                    "consent_date": device['consent_date'],
                     "privacy_policy_version": device['privacy_policy_version'],
                     "notifications_enabled": device['notifications_enabled']
                 },
                 "data_summary": {
                     "analytics_events_stored": analytics_count,
-                    "registration_date": device['created_at'].isoformat(),
+                    "registration_date": device['created_at'],
                     "data_retention_note": "Analytics data is retained while consent is active"
                 },
-                "your_rights": {
-                    "consent": "You can grant or revoke analytics consent at any time",
-                    "access": "You can request a copy of your data",
-                    "deletion": "You can request deletion of your data",
-                    "portability": "You can export your data in JSON format"
-                }
+                "your_rights": _STATUS_RIGHTS
             }
         }
         
@@ -100,27 +151,15 @@ async def set_analytics_consent(request: AnalyticsConsentRequest):
         
         device_token = validate_device_token(request.device_token)
         
-        # Get device ID
-        device_query = """
-            SELECT id FROM iosapp.device_users 
-            WHERE device_token = $1
-        """
-        device_result = await db_manager.execute_query(device_query, device_token)
-        
-        if not device_result:
-            raise HTTPException(status_code=404, detail="Device not found")
-        
-        device_id = device_result[0]['id']
-        
-        # Set consent using privacy service
-        success = await privacy_analytics_service.set_analytics_consent(
-            device_id, 
+        # Set consent using privacy service (device is resolved by token in the same query)
+        device_id = await privacy_analytics_service.set_analytics_consent_by_token(
+            device_token, 
             request.consent, 
             request.privacy_policy_version
         )
         
-        if not success:
-            raise HTTPException(status_code=500, detail="Failed to update consent")
+        if not device_id:
+            raise HTTPException(status_code=404, detail="Device not found")
         
         action = "granted" if request.consent else "revoked"
         data_action = "" if request.consent else " and existing data deleted"
@@ -131,7 +170,7 @@ async def set_analytics_consent(request: AnalyticsConsentRequest):
             "data": {
                 "analytics_consent": request.consent,
                 "privacy_policy_version": request.privacy_policy_version,
-                "consent_date": datetime.now(timezone.utc).isoformat(),
+                "consent_date": datetime.now(timezone.utc),
                 "data_retention": "Data will be collected and stored" if request.consent else "No data will be collected",
                 "rights_note": "You can change this setting at any time"
             }
@@ -176,25 +215,13 @@ async def set_analytics_consent_flexible(request: Dict[str, Any]):
         # Use the same logic as the main endpoint
         device_token = validate_device_token(device_token)
         
-        # Get device ID
-        device_query = """
-            SELECT id FROM iosapp.device_users 
-            WHERE device_token = $1
-        """
-        device_result = await db_manager.execute_query(device_query, device_token)
-        
-        if not device_result:
-            raise HTTPException(status_code=404, detail="Device not found")
-        
-        device_id = device_result[0]['id']
-        
-        # Set consent using privacy service
-        success = await privacy_analytics_service.set_analytics_consent(
-            device_id, consent, privacy_policy_version
+        # Set consent using privacy service (device is resolved by token in the same query)
+        device_id = await privacy_analytics_service.set_analytics_consent_by_token(
+            device_token, consent, privacy_policy_version
         )
         
-        if not success:
-            raise HTTPException(status_code=500, detail="Failed to update consent")
+        if not device_id:
+            raise HTTPException(status_code=404, detail="Device not found")
         
         action = "granted" if consent else "revoked"
         data_action = "" if consent else " and existing data deleted"
@@ -205,7 +232,7 @@ async def set_analytics_consent_flexible(request: Dict[str, Any]):
             "data": {
                 "analytics_consent": consent,
                 "privacy_policy_version": privacy_policy_version,
-                "consent_date": datetime.now(timezone.utc).isoformat(),
+                "consent_date": datetime.now(timezone.utc),
                 "data_retention": "Data will be collected and stored" if consent else "No data will be collected"
             }
         }
@@ -222,31 +249,20 @@ async def delete_user_data(device_token: str):
     try:
         device_token = validate_device_token(device_token)
         
-        # Get device ID
-        device_query = """
-            SELECT id FROM iosapp.device_users 
-            WHERE device_token = $1
-        """
-        device_result = await db_manager.execute_query(device_query, device_token)
+        # Revoke consent first, then delete events in separately committed batches;
+        # not atomic - if a batch fails, a retry of this endpoint deletes the rest
+        device_id, deleted_count = await privacy_analytics_service.delete_and_revoke_by_token(device_token)
         
-        if not device_result:
+        if not device_id:
             raise HTTPException(status_code=404, detail="Device not found")
         
-        device_id = device_result[0]['id']
-        
-        # Delete analytics data
-        deleted_count = await privacy_analytics_service.delete_analytics_data(device_id)
-        
-        # Revoke consent
-        await privacy_analytics_service.set_analytics_consent(device_id, False, "data_deleted")
-        
         return {
             "success": True,
             "message": "All analytics data deleted successfully",
             "data": {
                 "records_deleted": deleted_count,
                 "consent_status": "revoked",
-                "deletion_date": datetime.now(timezone.utc).isoformat(),
+                "deletion_date": datetime.now(timezone.utc),
                 "note": "Analytics consent has been revoked and all data removed"
             }
         }
@@ -263,40 +279,28 @@ async def export_user_data(request: DataExportRequest):
     try:
         device_token = validate_device_token(request.device_token)
         
-        # Get device ID
-        device_query = """
-            SELECT id FROM iosapp.device_users 
-            WHERE device_token = $1
-        """
-        device_result = await db_manager.execute_query(device_query, device_token)
+        # Resolve device and consent up front so errors still map to proper status codes
+        device = await privacy_analytics_service.get_export_device(device_token)
         
-        if not device_result:
+        if not device:
             raise HTTPException(status_code=404, detail="Device not found")
         
-        device_id = device_result[0]['id']
-        
-        # Export data using privacy service
-        export_data = await privacy_analytics_service.export_user_data(device_id)
-        
-        if not export_data:
-            raise HTTPException(status_code=500, detail="Failed to export user data")
-        
-        return {
-            "success": True,
-            "message": "User data exported successfully",
-            "data": export_data,
-            "export_info": {
-                "format": "JSON",
-                "exported_at": datetime.now(timezone.utc).isoformat(),
-                "includes": [
-                    "Device registration data",
-                    "Analytics events (if consented)",
-                    "Privacy preferences",
-                    "Consent history"
-                ],
-                "note": "This export contains all data associated with your device"
+        if not device['analytics_consent']:
+            return {
+                "success": True,
+                "message": "User data exported successfully",
+                "data": {
+                    "message": "No analytics data - user has not consented to tracking",
+                    "consent_status": "not_consented"
+                },
+                "export_info": _export_info()
             }
-        }
+        
+        # Analytics history can be large - stream it instead of building the payload in memory.
+        # The first page is read here, so a database that is down still yields a 500
+        pages = privacy_analytics_service.iter_analytics_event_pages(device['id'])
+        first_page = await anext(pages, [])
+        return StreamingResponse(_stream_export(device, first_page, pages), media_type="application/json")
         
     except HTTPException:
         raise
@@ -304,62 +308,97 @@ async def export_user_data(request: DataExportRequest):
         logger.error(f"Error exporting user data: {e}")
         raise HTTPException(status_code=500, detail="Failed to export user data")
 
-@router.get("/policy")
-async def get_privacy_policy():
-    """Get current privacy policy and data practices"""
+def _export_info() -> Dict[str, Any]:
+    """Export metadata appended to every data export"""
     return {
-        "success": True,
-        "data": {
-            "privacy_policy": {
-                "version": "1.0",
-                "effective_date": "2025-07-13",
-                "last_updated": "2025-07-13"
-            },
-            "data_collection": [
-                "Device registration information",
-                "Job search keywords and preferences", 
-                "App usage analytics (with consent)",
-                "Notification interaction data (with consent)"
-            ],
-            "data_usage": [
-                "To provide job notification services",
-                "To improve app functionality (with consent)", 
-                "To generate anonymous usage statistics"
-            ],
-            "data_retention": "Analytics data is kept while consent is active. Registration data is kept until account deletion.",
-            "your_rights": {
-                "consent": "Grant or revoke analytics consent at any time",
-                "access": "Request a copy of your personal data",
-                "deletion": "Request deletion of your personal data",
-                "portability": "Export your data in machine-readable format",
-                "objection": "Object to processing of your data"
-            },
-            "contact": {
-                "data_protection": "privacy@yourapp.com",
-                "support": "support@yourapp.com"
-            },
-            "legal_basis": {
-                "service_provision": "Contract performance (job notifications)",
-                "analytics": "Explicit consent",
-                "legitimate_interest": "Anonymous app improvement"
-            }
-        }
+        "format": "JSON",
+        "exported_at": datetime.now(timezone.utc),
+        "includes": [
+            "Device registration data",
+            "Analytics events (if consented)",
+            "Privacy preferences",
+            "Consent history"
+        ],
+        "note": "This export contains all data associated with your device"
     }
 
+async def _stream_export(device, first_page, pages: AsyncIterator) -> AsyncIterator[bytes]:
+    """
+    Yield the export JSON document in chunks, one chunk per page of analytics events
+    
+    If a later page fails the error propagates, so the server aborts the response
+    instead of terminating the body - the client sees a failed transfer, never a
+    complete-looking document with events missing.
+    """
+    device_info = dict(device)
+    del device_info['id']
+    
+    yield (
+        b'{"success":true,"message":"User data exported successfully","data":{"export_date":'
+        + orjson.dumps(datetime.now(timezone.utc))
+        + b',"device_info":' + orjson.dumps(device_info)
+        + b',"analytics_events":['
+    )
+    
+    total_events = 0
+    page = first_page
+    while page:
+        yield (b',' if total_events else b'') + b','.join(
+            orjson.dumps({
+                "action": row['action'],
+                "metadata": row['metadata'],
+                "timestamp": row['created_at']
+            })
+            for row in page
+        )
+        total_events += len(page)
+        try:
+            page = await anext(pages, [])
+        except Exception:
+            logger.exception(f"Aborting data export after {total_events} events")
+            raise
+    
+    yield (
+        b'],"total_events":' + str(total_events).encode()
+        + b',"consent_status":"consented"},"export_info":' + orjson.dumps(_export_info())
+        + b'}'
+    )
+
+@router.get("/policy")
+def get_privacy_policy(request: Request):
+    """Get current privacy policy and data practices"""
+    # Static payload - serve the pre-serialized bytes and honour conditional requests
+    # Weak comparison: a cached tag matches with or without the W/ prefix
+    if _POLICY_ETAG_OPAQUE in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=_POLICY_HEADERS)
+    
+    return Response(content=_POLICY_BYTES, media_type="application/json", headers=_POLICY_HEADERS)
+
 @router.get("/analytics/anonymous")
 async def get_anonymous_analytics():
     """Get anonymous analytics summary (no user consent required)"""
     try:
-        # Get anonymous analytics that don't identify users
-        summary = await privacy_analytics_service.get_analytics_summary_anonymous()
-        
-        return {
-            "success": True,
-            "message": "Anonymous analytics retrieved",
-            "data": summary,
-            "privacy_note": "This data is fully anonymized and contains no personally identifiable information"
-        }
+        cached = _anonymous_cache.get(_ANONYMOUS_CACHE_KEY)
+        if cached is None:
+            # Single-flight: concurrent misses wait for one aggregation instead of each hitting the DB
+            async with _anonymous_lock:
+                cached = _anonymous_cache.get(_ANONYMOUS_CACHE_KEY)
+                if cached is None:
+                    # Get anonymous analytics that don't identify users
+                    summary = await privacy_analytics_service.get_analytics_summary_anonymous()
+                    
+                    cached = orjson.dumps({
+                        "success": True,
+                        "message": "Anonymous analytics retrieved",
+                        "data": summary,
+                        "privacy_note": "This data is fully anonymized and contains no personally identifiable information"
+                    })
+                    # Don't pin a failed aggregation for the whole TTL
+                    if "error" not in summary:
+                        _anonymous_cache[_ANONYMOUS_CACHE_KEY] = cached
+        
+        return Response(content=cached, media_type="application/json")
         
     except Exception as e:
         logger.error(f"Error getting anonymous analytics: {e}")
-        raise HTTPException(status_code=500, detail="Failed to get analytics summary")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail="Failed to get analytics summary")
@@ -2,21 +2,189 @@
 User management endpoints for device-based iOS app
 Provides user profile, preferences, and account management
 """
-from fastapi import APIRouter, HTTPException, status, Depends
+from fastapi import APIRouter, HTTPException, Response, status, Depends
+from fastapi.responses import ORJSONResponse
 from typing import Dict, Any, List, Optional
 import logging
+import asyncpg
+import orjson
 from datetime import datetime, timezone
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field
 
 from app.core.database import db_manager
 from app.utils.validation import validate_device_token, validate_keywords, validate_email
 from app.services.analytics_service import analytics_service
 
-router = APIRouter()
+router = APIRouter(default_response_class=ORJSONResponse)
 logger = logging.getLogger(__name__)
 
+# Hot-path SQL kept as module constants so every call sends identical text and
+# reuses asyncpg's per-connection prepared statement cache
+# Profile/preference writes are single upserts on users.device_id (unique) -
+# no existence check beforehand
+UPSERT_USER_PROFILE_SQL = """
+    INSERT INTO iosapp.users 
+    (device_id, first_name, email, location, current_job_title, years_of_experience,
+     min_salary, max_salary, remote_work_preference, created_at, updated_at)
+    SELECT d.id, $2, $3, $4, $5, $6, $7, $8, $9, NOW(), NOW()
+    FROM iosapp.device_users d
+    WHERE d.device_token = $1
+    ON CONFLICT (device_id) DO UPDATE
+    SET first_name = EXCLUDED.first_name, email = EXCLUDED.email,
+        location = EXCLUDED.location, current_job_title = EXCLUDED.current_job_title,
+        years_of_experience = EXCLUDED.years_of_experience,
+        min_salary = EXCLUDED.min_salary, max_salary = EXCLUDED.max_salary,
+        remote_work_preference = EXCLUDED.remote_work_preference, updated_at = NOW()
+    RETURNING device_id, NOW() AS updated_at
+"""
+
+UPDATE_DEVICE_PREFERENCES_SQL = """
+    UPDATE iosapp.device_users 
+    SET keywords = $2, notifications_enabled = $3
+    WHERE device_token = $1
+    RETURNING id
+"""
+
+UPSERT_USER_PREFERENCES_SQL = """
+    INSERT INTO iosapp.users 
+    (device_id, keywords, preferred_sources, notifications_enabled,
+     notification_frequency, quiet_hours_start, quiet_hours_end, created_at, updated_at)
+    VALUES ($1, $2, $3, $4, $5, $6, $7, NOW(), NOW())
+    ON CONFLICT (device_id) DO UPDATE
+    SET keywords = EXCLUDED.keywords, preferred_sources = EXCLUDED.preferred_sources,
+        notifications_enabled = EXCLUDED.notifications_enabled,
+        notification_frequency = EXCLUDED.notification_frequency,
+        quiet_hours_start = EXCLUDED.quiet_hours_start, quiet_hours_end = EXCLUDED.quiet_hours_end,
+        updated_at = NOW()
+    RETURNING NOW() AS updated_at
+"""
+
+DELETE_ACCOUNT_BY_TOKEN_SQL = """
+    WITH device AS (
+        SELECT id FROM iosapp.device_users WHERE device_token = $1
+    ), deleted_user AS (
+        DELETE FROM iosapp.users WHERE device_id IN (SELECT id FROM device)
+    ), deleted_analytics AS (
+        DELETE FROM iosapp.user_analytics WHERE device_id IN (SELECT id FROM device)
+    )
+    DELETE FROM iosapp.device_users WHERE id IN (SELECT id FROM device)
+    RETURNING id, NOW() AS deleted_at
+"""
+
+# Device row, extended profile (as JSON) and analytics summary in one round-trip
+PROFILE_BY_TOKEN_SQL = """
+    SELECT d.id, d.device_token, d.keywords, d.notifications_enabled, d.created_at,
+           u.user_json,
+           a.total_actions, a.jobs_viewed, a.notifications_received, a.chat_messages, a.last_activity
+    FROM iosapp.device_users d
+    LEFT JOIN LATERAL (
+        SELECT row_to_json(p) AS user_json
+        FROM (
+            -- Only the columns the profile response reads
+            SELECT u.email, u.location, u.quiet_hours_start, u.quiet_hours_end
+            FROM iosapp.users u
+            WHERE u.device_id = d.id
+        ) p
+    ) u ON TRUE
+    CROSS JOIN LATERAL (
+        SELECT 
+            COUNT(*) as total_actions,
+            COUNT(CASE WHEN action = 'job_view' THEN 1 END) as jobs_viewed,
+            COUNT(CASE WHEN action = 'notification_received' THEN 1 END) as notifications_received,
+            COUNT(CASE WHEN action = 'chat_message' THEN 1 END) as chat_messages,
+            MAX(created_at) as last_activity
+        FROM iosapp.user_analytics
+        WHERE device_id = d.id
+    ) a
+    WHERE d.device_token = $1
+"""
+
+# Keyset pagination: cost is O(limit) however deep the client pages. The cursor is
+# (created_at, id) since events written by one statement share a timestamp; without
+# an id the row comparison reduces to created_at < $2 for older clients
+USER_ACTIVITY_SQL = """
+    SELECT id, action, metadata, created_at
+    FROM iosapp.user_analytics
+    WHERE device_id = $1 AND ($2::timestamptz IS NULL OR (created_at, id) < ($2, $3))
+    ORDER BY created_at DESC, id DESC
+    LIMIT $4
+"""
+
+# Stats read from the daily rollups maintained by triggers on user_analytics and
+# notification_hashes (see POST /health/create-user-stats-rollup), so the cost is
+# bounded by days of history rather than by number of events; get_user_stats falls
+# back to USER_STATS_DIRECT_SQL until those tables exist
+USER_STATS_SQL = """
+    SELECT d.id, d.created_at, s.*, n.*
+    FROM iosapp.device_users d
+    CROSS JOIN LATERAL (
+        SELECT 
+            COALESCE(SUM(count), 0)::bigint as total_actions,
+            COALESCE(SUM(count) FILTER (WHERE action = 'job_view'), 0)::bigint as jobs_viewed,
+            COALESCE(SUM(count) FILTER (WHERE action = 'notification_received'), 0)::bigint as notifications_received,
+            COALESCE(SUM(count) FILTER (WHERE action = 'chat_message'), 0)::bigint as chat_messages,
+            COALESCE(SUM(count) FILTER (WHERE action = 'job_application'), 0)::bigint as applications_tracked,
+            COALESCE(SUM(count) FILTER (WHERE day > CURRENT_DATE - 7), 0)::bigint as actions_last_7_days,
+            COALESCE(SUM(count) FILTER (WHERE day > CURRENT_DATE - 30), 0)::bigint as actions_last_30_days,
+            MAX(last_at) as last_activity
+        FROM iosapp.user_stats_daily
+        WHERE device_id = d.id
+    ) s
+    CROSS JOIN LATERAL (
+        SELECT 
+            COALESCE(SUM(count), 0)::bigint as total_notifications,
+            COUNT(DISTINCT NULLIF(job_source, '')) as unique_sources,
+            COALESCE(SUM(count) FILTER (WHERE day > CURRENT_DATE - 7), 0)::bigint as notifications_last_7_days,
+            COALESCE(SUM(count) FILTER (WHERE day > CURRENT_DATE - 30), 0)::bigint as notifications_last_30_days
+        FROM iosapp.notification_hashes_daily
+        WHERE device_id = d.id
+    ) n
+    WHERE d.device_token = $1
+"""
+
+# Same columns aggregated from the raw event tables, for deployments where the
+# rollup tables have not been created yet. The 7/30-day windows use the same
+# calendar-day buckets as the rollups (::date in the session timezone, today
+# included), so both paths return identical counts
+USER_STATS_DIRECT_SQL = """
+    SELECT d.id, d.created_at, s.*, n.*
+    FROM iosapp.device_users d
+    CROSS JOIN LATERAL (
+        SELECT 
+            COUNT(*) as total_actions,
+            COUNT(*) FILTER (WHERE action = 'job_view') as jobs_viewed,
+            COUNT(*) FILTER (WHERE action = 'notification_received') as notifications_received,
+            COUNT(*) FILTER (WHERE action = 'chat_message') as chat_messages,
+            COUNT(*) FILTER (WHERE action = 'job_application') as applications_tracked,
+            COUNT(*) FILTER (WHERE created_at::date > CURRENT_DATE - 7) as actions_last_7_days,
+            COUNT(*) FILTER (WHERE created_at::date > CURRENT_DATE - 30) as actions_last_30_days,
+            MAX(created_at) as last_activity
+        FROM iosapp.user_analytics
+        WHERE device_id = d.id
+    ) s
+    CROSS JOIN LATERAL (
+        SELECT 
+            COUNT(*) as total_notifications,
+            COUNT(DISTINCT NULLIF(job_source, '')) as unique_sources,
+            COUNT(*) FILTER (WHERE sent_at::date > CURRENT_DATE - 7) as notifications_last_7_days,
+            COUNT(*) FILTER (WHERE sent_at::date > CURRENT_DATE - 30) as notifications_last_30_days
+        FROM iosapp.notification_hashes
+        WHERE device_id = d.id
+    ) n
+    WHERE d.device_token = $1
+"""
+
+# Profiles are re-read on every app foreground but change rarely - the encoded response
+# body is kept per device token in db_manager.profile_cache, which every device_users
+# writer evicts through db_manager.forget_device_profiles / forget_device_tokens
+_PROFILE_HEADERS = {"Cache-Control": f"private, max-age={db_manager.PROFILE_CACHE_TTL}"}
+
 # Pydantic models for request/response
+_MODEL_CONFIG = ConfigDict(extra='ignore', str_strip_whitespace=True)
+
 class UserProfile(BaseModel):
+    model_config = _MODEL_CONFIG
+    
     name: Optional[str] = Field(None, max_length=100)
     email: Optional[str] = Field(None, max_length=255)
     location: Optional[str] = Field(None, max_length=100)
@@ -27,6 +195,8 @@ class UserProfile(BaseModel):
     remote_preference: Optional[str] = Field(None, description="Remote, Hybrid, Onsite, Any")
 
 class UserPreferences(BaseModel):
+    model_config = _MODEL_CONFIG
+    
     keywords: List[str] = Field(default_factory=list)
     preferred_sources: List[str] = Field(default_factory=list)
     notifications_enabled: bool = True
@@ -34,15 +204,24 @@ class UserPreferences(BaseModel):
     quiet_hours_start: Optional[int] = Field(None, ge=0, le=23)
     quiet_hours_end: Optional[int] = Field(None, ge=0, le=23)
 
+# Fallbacks for devices without a users row come from the model defaults, built once
+_PREFERENCE_DEFAULTS = UserPreferences().model_dump()
+
 class UpdateProfileRequest(BaseModel):
+    model_config = _MODEL_CONFIG
+    
     device_token: str
     profile: UserProfile
 
 class UpdatePreferencesRequest(BaseModel):
+    model_config = _MODEL_CONFIG
+    
     device_token: str
     preferences: UserPreferences
 
 class DeleteAccountRequest(BaseModel):
+    model_config = _MODEL_CONFIG
+    
     device_token: str
     confirmation: str  # User must type "DELETE" to confirm
 
@@ -53,89 +232,32 @@ async def get_user_profile(device_token: str):
         # Validate device token
         device_token = validate_device_token(device_token)
         
-        # Get device user
-        device_query = """
-            SELECT id, device_token, keywords, notifications_enabled, created_at
-            FROM iosapp.device_users 
-            WHERE device_token = $1
-        """
-        device_result = await db_manager.execute_query(device_query, device_token)
+        cached = db_manager.profile_cache.get(device_token)
+        if cached is not None:
+            device_id, body = cached
+            analytics_service.track_action(
+                device_id=device_id,
+                action="profile_view",
+                metadata={"endpoint": "get_user_profile"}
+            )
+            return Response(body, media_type="application/json", headers=_PROFILE_HEADERS)
+        
+        # Get device user, extended profile and analytics summary in one query
+        device_user = await db_manager.fetchrow(PROFILE_BY_TOKEN_SQL, device_token)
         
-        if not device_result:
+        if device_user is None:
             raise HTTPException(
                 status_code=404,
                 detail="Device not found. Please register first."
             )
         
-        device_user = device_result[0]
-        
-        # Check if user has extended profile in users table (using JOIN)
-        user_query = """
-            SELECT u.id, u.email, u.first_name, u.last_name, u.phone, u.location, 
-                   u.current_job_title, u.years_of_experience, u.linkedin_profile, 
-                   u.portfolio_url, u.bio, u.desired_job_types, u.remote_work_preference,
-                   u.skills, u.preferred_locations, u.min_salary, u.max_salary,
-                   u.salary_currency, u.salary_negotiable, u.job_matches_enabled,
-                   u.application_reminders_enabled, u.weekly_digest_enabled,
-                   u.market_insights_enabled, u.quiet_hours_enabled, u.quiet_hours_start,
-                   u.quiet_hours_end, u.preferred_notification_time, u.profile_visibility,
-                   u.share_analytics, u.share_job_view_history, u.allow_personalized_recommendations,
-                   u.profile_completeness, u.created_at, u.updated_at
-            FROM iosapp.users u
-            JOIN iosapp.device_users du ON u.device_id = du.id
-            WHERE du.device_token = $1
-        """
-        user_result = await db_manager.execute_query(user_query, device_token)
-        
-        # Get user analytics summary
-        analytics_query = """
-            SELECT 
-                COUNT(*) as total_actions,
-                COUNT(CASE WHEN action = 'job_view' THEN 1 END) as jobs_viewed,
-                COUNT(CASE WHEN action = 'notification_received' THEN 1 END) as notifications_received,
-                COUNT(CASE WHEN action = 'chat_message' THEN 1 END) as chat_messages,
-                MAX(created_at) as last_activity
-            FROM iosapp.user_analytics
-            WHERE device_id = $1
-        """
-        analytics = await db_manager.execute_query(analytics_query, device_user['id'])
-        
-        # Build response
+        # Build response - profile/preferences come from the extended profile when present
+        user = device_user['user_json'] or {}
         profile_data = {
             "device_id": str(device_user['id']),
             "device_token": device_user['device_token'],
-            "registration_date": device_user['created_at'].isoformat(),
+            "registration_date": device_user['created_at'],
             "profile": {
-                "name": None,
-                "email": None,
-                "location": None,
-                "job_title": None,
-                "experience_level": None,
-                "salary_min": None,
-                "salary_max": None,
-                "remote_preference": None
-            },
-            "preferences": {
-                "keywords": device_user['keywords'] or [],
-                "preferred_sources": [],
-                "notifications_enabled": device_user['notifications_enabled'],
-                "notification_frequency": "real_time",
-                "quiet_hours_start": None,
-                "quiet_hours_end": None
-            },
-            "analytics": {
-                "total_actions": analytics[0]['total_actions'] if analytics else 0,
-                "jobs_viewed": analytics[0]['jobs_viewed'] if analytics else 0,
-                "notifications_received": analytics[0]['notifications_received'] if analytics else 0,
-                "chat_messages": analytics[0]['chat_messages'] if analytics else 0,
-                "last_activity": analytics[0]['last_activity'].isoformat() if analytics and analytics[0]['last_activity'] else None
-            }
-        }
-        
-        # If user has extended profile, update with that data
-        if user_result:
-            user = user_result[0]
-            profile_data["profile"].update({
                 "name": user.get('name'),
                 "email": user.get('email'),
                 "location": user.get('location'),
@@ -144,24 +266,36 @@ async def get_user_profile(device_token: str):
                 "salary_min": user.get('salary_min'),
                 "salary_max": user.get('salary_max'),
                 "remote_preference": user.get('remote_preference')
-            })
-            profile_data["preferences"].update({
+            },
+            "preferences": {
                 "keywords": user.get('keywords') or device_user['keywords'] or [],
-                "preferred_sources": user.get('preferred_sources') or [],
+                "preferred_sources": user.get('preferred_sources') or _PREFERENCE_DEFAULTS['preferred_sources'],
                 "notifications_enabled": user.get('notifications_enabled', device_user['notifications_enabled']),
-                "notification_frequency": user.get('notification_frequency', 'real_time'),
+                "notification_frequency": user.get('notification_frequency', _PREFERENCE_DEFAULTS['notification_frequency']),
                 "quiet_hours_start": user.get('quiet_hours_start'),
                 "quiet_hours_end": user.get('quiet_hours_end')
-            })
+            },
+            "analytics": {
+                "total_actions": device_user['total_actions'],
+                "jobs_viewed": device_user['jobs_viewed'],
+                "notifications_received": device_user['notifications_received'],
+                "chat_messages": device_user['chat_messages'],
+                "last_activity": device_user['last_activity']
+            }
+        }
+        
+        # Encode once; cache hits send these bytes as-is
+        body = orjson.dumps(profile_data)
+        db_manager.profile_cache[device_token] = (device_user['id'], body)
         
         # Track analytics
-        await analytics_service.track_action(
+        analytics_service.track_action(
             device_id=device_user['id'],
             action="profile_view",
             metadata={"endpoint": "get_user_profile"}
         )
         
-        return profile_data
+        return Response(body, media_type="application/json", headers=_PROFILE_HEADERS)
         
     except HTTPException:
         raise
@@ -183,84 +317,41 @@ async def update_user_profile(request: UpdateProfileRequest):
         if request.profile.email:
             request.profile.email = validate_email(request.profile.email)
         
-        # Get device user
-        device_query = """
-            SELECT id FROM iosapp.device_users 
-            WHERE device_token = $1
-        """
-        device_result = await db_manager.execute_query(device_query, device_token)
+        # Upsert the profile for the device in one statement; no row back means unknown device
+        upserted = await db_manager.fetchrow(
+            UPSERT_USER_PROFILE_SQL,
+            device_token,
+            request.profile.name,
+            request.profile.email,
+            request.profile.location,
+            request.profile.job_title,
+            request.profile.experience_level,
+            request.profile.salary_min,
+            request.profile.salary_max,
+            request.profile.remote_preference
+        )
         
-        if not device_result:
+        if upserted is None:
             raise HTTPException(
                 status_code=404,
                 detail="Device not found. Please register first."
             )
         
-        device_id = device_result[0]['id']
-        
-        # Check if user profile exists (using JOIN)
-        user_check_query = """
-            SELECT u.id FROM iosapp.users u
-            JOIN iosapp.device_users du ON u.device_id = du.id
-            WHERE du.device_token = $1
-        """
-        existing_user = await db_manager.execute_query(user_check_query, device_token)
-        
-        if existing_user:
-            # Update existing profile (using device_id)
-            update_query = """
-                UPDATE iosapp.users 
-                SET first_name = $2, email = $3, location = $4, current_job_title = $5,
-                    years_of_experience = $6, min_salary = $7, max_salary = $8,
-                    remote_work_preference = $9, updated_at = NOW()
-                WHERE device_id = $1
-                RETURNING id
-            """
-            await db_manager.execute_command(
-                update_query,
-                device_id,
-                request.profile.name,
-                request.profile.email,
-                request.profile.location,
-                request.profile.job_title,
-                request.profile.experience_level,
-                request.profile.salary_min,
-                request.profile.salary_max,
-                request.profile.remote_preference
-            )
-        else:
-            # Create new profile
-            create_query = """
-                INSERT INTO iosapp.users 
-                (device_token, name, email, location, job_title, experience_level,
-                 salary_min, salary_max, remote_preference, created_at, updated_at)
-                VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, NOW(), NOW())
-                RETURNING id
-            """
-            await db_manager.execute_command(
-                create_query,
-                device_token,
-                request.profile.name,
-                request.profile.email,
-                request.profile.location,
-                request.profile.job_title,
-                request.profile.experience_level,
-                request.profile.salary_min,
-                request.profile.salary_max,
-                request.profile.remote_preference
-            )
+        device_id = upserted['device_id']
+        
+        db_manager.forget_device_profiles(device_token)
         
         # Track analytics
-        await analytics_service.track_action(
+        analytics_service.track_action(
             device_id=device_id,
             action="profile_update",
-            metadata={"fields_updated": [k for k, v in request.profile.dict().items() if v is not None]}
+            metadata={"fields_updated": list(request.profile.model_dump(exclude_none=True))}
         )
         
         return {
             "success": True,
             "message": "Profile updated successfully",
-            "timestamp": datetime.now(timezone.utc).isoformat()
+            "timestamp": upserted['updated_at']
         }
         
     except HTTPException:
@@ -280,82 +371,36 @@ async def update_user_preferences(request: UpdatePreferencesRequest):
         device_token = validate_device_token(request.device_token)
         keywords = validate_keywords(request.preferences.keywords)
         
-        # Get device user
-        device_query = """
-            SELECT id FROM iosapp.device_users 
-            WHERE device_token = $1
-        """
-        device_result = await db_manager.execute_query(device_query, device_token)
+        # Update device user preferences; no row back means unknown device
+        device_id = await db_manager.fetchval(
+            UPDATE_DEVICE_PREFERENCES_SQL,
+            device_token,
+            keywords,
+            request.preferences.notifications_enabled
+        )
         
-        if not device_result:
+        if device_id is None:
             raise HTTPException(
                 status_code=404,
                 detail="Device not found. Please register first."
             )
         
-        device_id = device_result[0]['id']
-        
-        # Update device user preferences
-        device_update_query = """
-            UPDATE iosapp.device_users 
-            SET keywords = $2, notifications_enabled = $3
-            WHERE device_token = $1
-        """
-        await db_manager.execute_command(
-            device_update_query,
-            device_token,
+        # Update or create extended preferences in users table
+        updated_at = await db_manager.fetchval(
+            UPSERT_USER_PREFERENCES_SQL,
+            device_id,
             keywords,
-            request.preferences.notifications_enabled
+            request.preferences.preferred_sources,
+            request.preferences.notifications_enabled,
+            request.preferences.notification_frequency,
+            request.preferences.quiet_hours_start,
+            request.preferences.quiet_hours_end
         )
         
-        # Update or create extended preferences in users table (using JOIN)
-        user_check_query = """
-            SELECT u.id FROM iosapp.users u
-            JOIN iosapp.device_users du ON u.device_id = du.id
-            WHERE du.device_token = $1
-        """
-        existing_user = await db_manager.execute_query(user_check_query, device_token)
-        
-        if existing_user:
-            # Update existing preferences
-            preferences_update_query = """
-                UPDATE iosapp.users 
-                SET keywords = $2, preferred_sources = $3, notifications_enabled = $4,
-                    notification_frequency = $5, quiet_hours_start = $6, quiet_hours_end = $7,
-                    updated_at = NOW()
-                WHERE device_token = $1
-            """
-            await db_manager.execute_command(
-                preferences_update_query,
-                device_token,
-                keywords,
-                request.preferences.preferred_sources,
-                request.preferences.notifications_enabled,
-                request.preferences.notification_frequency,
-                request.preferences.quiet_hours_start,
-                request.preferences.quiet_hours_end
-            )
-        else:
-            # Create minimal user record for preferences
-            create_preferences_query = """
-                INSERT INTO iosapp.users 
-                (device_token, keywords, preferred_sources, notifications_enabled,
-                 notification_frequency, quiet_hours_start, quiet_hours_end, created_at, updated_at)
-                VALUES ($1, $2, $3, $4, $5, $6, $7, NOW(), NOW())
-            """
-            await db_manager.execute_command(
-                create_preferences_query,
-                device_token,
-                keywords,
-                request.preferences.preferred_sources,
-                request.preferences.notifications_enabled,
-                request.preferences.notification_frequency,
-                request.preferences.quiet_hours_start,
-                request.preferences.quiet_hours_end
-            )
+        db_manager.forget_device_profiles(device_token)
         
         # Track analytics
-        await analytics_service.track_action(
+        analytics_service.track_action(
             device_id=device_id,
             action="preferences_update",
             metadata={
@@ -370,7 +415,7 @@ async def update_user_preferences(request: UpdatePreferencesRequest):
             "message": "Preferences updated successfully",
             "updated_keywords": keywords,
             "notifications_enabled": request.preferences.notifications_enabled,
-            "timestamp": datetime.now(timezone.utc).isoformat()
+            "timestamp": updated_at
         }
         
     except HTTPException:
@@ -383,61 +428,50 @@ async def update_user_preferences(request: UpdatePreferencesRequest):
         )
 
 @router.get("/activity/{device_token}")
-async def get_user_activity(device_token: str, limit: int = 50, offset: int = 0):
-    """Get user activity history"""
+async def get_user_activity(
+    device_token: str,
+    limit: int = 50,
+    before: Optional[datetime] = None,
+    before_id: Optional[str] = None
+):
+    """Get user activity history, newest first; pass next_cursor / next_cursor_id back as `before` / `before_id`"""
     try:
         # Validate device token
         device_token = validate_device_token(device_token)
         
-        # Get device user
-        device_query = """
-            SELECT id FROM iosapp.device_users 
-            WHERE device_token = $1
-        """
-        device_result = await db_manager.execute_query(device_query, device_token)
+        # Get device user (cached per token)
+        device_id = await db_manager.get_device_id(device_token)
         
-        if not device_result:
+        if device_id is None:
             raise HTTPException(
                 status_code=404,
                 detail="Device not found"
             )
         
-        device_id = device_result[0]['id']
-        
-        # Get user activity
-        activity_query = """
-            SELECT action, metadata, created_at
-            FROM iosapp.user_analytics
-            WHERE device_id = $1
-            ORDER BY created_at DESC
-            LIMIT $2 OFFSET $3
-        """
-        activities = await db_manager.execute_query(activity_query, device_id, limit, offset)
-        
-        # Get total count
-        count_query = """
-            SELECT COUNT(*) as total
-            FROM iosapp.user_analytics
-            WHERE device_id = $1
-        """
-        total_result = await db_manager.execute_query(count_query, device_id)
-        total_count = total_result[0]['total'] if total_result else 0
+        # Get user activity (one extra row tells us whether another page exists)
+        try:
+            activities = await db_manager.execute_query(USER_ACTIVITY_SQL, device_id, before, before_id, limit + 1)
+        except asyncpg.DataError:
+            raise HTTPException(status_code=400, detail="Invalid before_id cursor")
+        has_more = len(activities) > limit
+        activities = activities[:limit]
         
         activity_list = []
         for activity in activities:
             activity_list.append({
                 "action": activity['action'],
                 "metadata": activity['metadata'] or {},
-                "timestamp": activity['created_at'].isoformat()
+                "timestamp": activity['created_at']
             })
         
-        return {
+        # Returning the response directly skips FastAPI's jsonable_encoder pass
+        return ORJSONResponse({
             "activities": activity_list,
-            "total_count": total_count,
             "limit": limit,
-            "offset": offset,
-            "has_more": offset + len(activity_list) < total_count
-        }
+            "next_cursor": activities[-1]['created_at'] if has_more else None,
+            "next_cursor_id": activities[-1]['id'] if has_more else None,
+            "has_more": has_more
+        })
         
     except HTTPException:
         raise
@@ -462,45 +496,21 @@ async def delete_user_account(request: DeleteAccountRequest):
                 detail="Account deletion requires confirmation string 'DELETE'"
             )
         
-        # Get device user
-        device_query = """
-            SELECT id FROM iosapp.device_users 
-            WHERE device_token = $1
-        """
-        device_result = await db_manager.execute_query(device_query, device_token)
+        # Delete all user data atomically in one statement (notification hashes cascade
+        # from device_users); no row back means unknown device
+        deleted = await db_manager.fetchrow(DELETE_ACCOUNT_BY_TOKEN_SQL, device_token)
         
-        if not device_result:
+        if deleted is None:
             raise HTTPException(
                 status_code=404,
                 detail="Device not found"
             )
-        
-        device_id = device_result[0]['id']
-        
-        # Delete all user data (cascading deletes will handle related records)
-        # 1. Delete from users table (if exists) - using device_id
-        await db_manager.execute_command(
-            "DELETE FROM iosapp.users WHERE device_id = $1",
-            device_id
-        )
-        
-        # 2. Delete analytics (manual since no FK constraint)
-        await db_manager.execute_command(
-            "DELETE FROM iosapp.user_analytics WHERE device_id = $1",
-            device_id
-        )
-        
-        # 3. Delete notification hashes (has FK constraint, will cascade)
-        # 4. Delete device user (this will cascade to notification_hashes)
-        await db_manager.execute_command(
-            "DELETE FROM iosapp.device_users WHERE device_token = $1",
-            device_token
-        )
+        db_manager.forget_device_tokens(device_token)
         
         return {
             "success": True,
             "message": "Account deleted successfully. All user data has been removed.",
-            "timestamp": datetime.now(timezone.utc).isoformat()
+            "timestamp": deleted['deleted_at']
         }
         
     except HTTPException:
@@ -519,62 +529,28 @@ async def get_user_stats(device_token: str):
         # Validate device token
         device_token = validate_device_token(device_token)
         
-        # Get device user
-        device_query = """
-            SELECT id, created_at FROM iosapp.device_users 
-            WHERE device_token = $1
-        """
-        device_result = await db_manager.execute_query(device_query, device_token)
+        # Device, activity and notification stats in one round-trip
+        try:
+            stats_data = await db_manager.fetchrow(USER_STATS_SQL, device_token)
+        except asyncpg.UndefinedTableError:
+            stats_data = await db_manager.fetchrow(USER_STATS_DIRECT_SQL, device_token)
         
-        if not device_result:
+        if stats_data is None:
             raise HTTPException(
                 status_code=404,
                 detail="Device not found"
             )
         
-        device_id = device_result[0]['id']
-        registration_date = device_result[0]['created_at']
-        
-        # Get comprehensive stats
-        stats_query = """
-            SELECT 
-                COUNT(*) as total_actions,
-                COUNT(CASE WHEN action = 'job_view' THEN 1 END) as jobs_viewed,
-                COUNT(CASE WHEN action = 'notification_received' THEN 1 END) as notifications_received,
-                COUNT(CASE WHEN action = 'chat_message' THEN 1 END) as chat_messages,
-                COUNT(CASE WHEN action = 'job_application' THEN 1 END) as applications_tracked,
-                COUNT(CASE WHEN created_at > NOW() - INTERVAL '7 days' THEN 1 END) as actions_last_7_days,
-                COUNT(CASE WHEN created_at > NOW() - INTERVAL '30 days' THEN 1 END) as actions_last_30_days,
-                MAX(created_at) as last_activity,
-                MIN(created_at) as first_activity
-            FROM iosapp.user_analytics
-            WHERE device_id = $1
-        """
-        stats = await db_manager.execute_query(stats_query, device_id)
-        
-        # Get notification stats
-        notification_stats_query = """
-            SELECT 
-                COUNT(*) as total_notifications,
-                COUNT(DISTINCT job_source) as unique_sources,
-                COUNT(CASE WHEN sent_at > NOW() - INTERVAL '7 days' THEN 1 END) as notifications_last_7_days,
-                COUNT(CASE WHEN sent_at > NOW() - INTERVAL '30 days' THEN 1 END) as notifications_last_30_days
-            FROM iosapp.notification_hashes
-            WHERE device_id = $1
-        """
-        notification_stats = await db_manager.execute_query(notification_stats_query, device_id)
+        registration_date = stats_data['created_at']
         
         # Calculate days since registration
         days_since_registration = (datetime.now(timezone.utc) - registration_date.replace(tzinfo=timezone.utc)).days
         
-        stats_data = stats[0] if stats else {}
-        notification_data = notification_stats[0] if notification_stats else {}
-        
-        return {
+        return ORJSONResponse({
             "account": {
-                "registration_date": registration_date.isoformat(),
+                "registration_date": registration_date,
                 "days_since_registration": days_since_registration,
-                "last_activity": stats_data.get('last_activity').isoformat() if stats_data.get('last_activity') else None
+                "last_activity": stats_data['last_activity']
             },
             "activity": {
                 "total_actions": stats_data.get('total_actions', 0),
@@ -585,18 +561,18 @@ async def get_user_stats(device_token: str):
                 "actions_last_30_days": stats_data.get('actions_last_30_days', 0)
             },
             "notifications": {
-                "total_received": notification_data.get('total_notifications', 0),
-                "unique_sources": notification_data.get('unique_sources', 0),
-                "last_7_days": notification_data.get('notifications_last_7_days', 0),
-                "last_30_days": notification_data.get('notifications_last_30_days', 0)
+                "total_received": stats_data.get('total_notifications', 0),
+                "unique_sources": stats_data.get('unique_sources', 0),
+                "last_7_days": stats_data.get('notifications_last_7_days', 0),
+                "last_30_days": stats_data.get('notifications_last_30_days', 0)
             },
             "engagement": {
                 "avg_actions_per_day": round(stats_data.get('total_actions', 0) / max(days_since_registration, 1), 2),
                 "notification_engagement_rate": round(
-                    (stats_data.get('jobs_viewed', 0) / max(notification_data.get('total_notifications', 1), 1)) * 100, 2
+                    (stats_data.get('jobs_viewed', 0) / max(stats_data.get('total_notifications', 1), 1)) * 100, 2
                 )
             }
-        }
+        })
         
     except HTTPException:
         raise
@@ -3,10 +3,13 @@ from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sess
 from sqlalchemy.orm import DeclarativeBase
 from sqlalchemy.exc import DisconnectionError, OperationalError
 from sqlalchemy import text
-from typing import AsyncGenerator
+from typing import AsyncGenerator, Optional
+from cachetools import TTLCache
+from contextlib import asynccontextmanager
 import logging
 import asyncio
 import time
+import orjson
 
 from app.core.config import settings
 
@@ -103,12 +106,40 @@ async def get_db() -> AsyncGenerator[AsyncSession, None]:
                 raise
             await asyncio.sleep(retry_delay * (attempt + 1))
 
+def _encode_json(value) -> str:
+    """Serialise with orjson; text that is already JSON is passed through as-is"""
+    return value if isinstance(value, str) else orjson.dumps(value).decode()
+
+async def _init_connection(conn):
+    """Per-connection codecs: UUIDs come back as str, since callers str() them anyway;
+    json/jsonb are (de)serialised with orjson, so callers bind and read plain lists/dicts"""
+    await conn.set_type_codec('uuid', encoder=str, decoder=str, schema='pg_catalog', format='text')
+    for json_type in ('json', 'jsonb'):
+        await conn.set_type_codec(json_type, encoder=_encode_json, decoder=orjson.loads, schema='pg_catalog', format='text')
+
+# What a failed query can raise: server-side errors, a dropped/broken connection,
+# or command_timeout; endpoints catch these rather than a blanket Exception
+DB_ERRORS = (asyncpg.PostgresError, asyncpg.InterfaceError, OSError, asyncio.TimeoutError)
+
+DEVICE_ID_BY_TOKEN_SQL = "SELECT id FROM iosapp.device_users WHERE device_token = $1"
+
 class DatabaseManager:
     """Direct database operations using asyncpg for complex queries"""
     
+    # device_token -> device_users.id only changes on delete or token refresh;
+    # the TTL bounds staleness across workers, which keep their own cache
+    DEVICE_ID_CACHE_SIZE = 100_000
+    DEVICE_ID_CACHE_TTL = 300  # seconds
+    
+    # Encoded GET /users/profile bodies; every device_users write must evict its token
+    PROFILE_CACHE_SIZE = 50_000
+    PROFILE_CACHE_TTL = 30  # seconds
+    
     def __init__(self):
         self.pool = None
         self._pool_lock = asyncio.Lock()
+        self._device_ids: TTLCache = TTLCache(maxsize=self.DEVICE_ID_CACHE_SIZE, ttl=self.DEVICE_ID_CACHE_TTL)
+        self.profile_cache: TTLCache = TTLCache(maxsize=self.PROFILE_CACHE_SIZE, ttl=self.PROFILE_CACHE_TTL)
     
     async def init_pool(self):
         """Initialize connection pool with retry logic"""
@@ -119,11 +150,16 @@ class DatabaseManager:
                     try:
                         # Remove asyncpg from URL for direct asyncpg connection
                         db_url = settings.DATABASE_URL.replace("+asyncpg", "")
+                        # Each worker gets its share of the connection budget
+                        max_size = max(settings.DB_MAX_CONNECTIONS // max(settings.WEB_CONCURRENCY, 1), settings.DB_POOL_MIN_SIZE)
                         self.pool = await asyncpg.create_pool(
                             db_url,
-                            min_size=2,
-                            max_size=8,
-                            command_timeout=60,
+                            min_size=settings.DB_POOL_MIN_SIZE,
+                            max_size=max_size,
+                            max_inactive_connection_lifetime=settings.DB_POOL_MAX_INACTIVE_LIFETIME,
+                            command_timeout=settings.DB_COMMAND_TIMEOUT,
+                            statement_cache_size=0 if settings.DB_USE_PGBOUNCER else settings.DB_STATEMENT_CACHE_SIZE,
+                            init=_init_connection,
                             server_settings={
                                 'application_name': 'birjob_ios_backend',
                             }
@@ -136,8 +172,15 @@ class DatabaseManager:
                             raise
                         await asyncio.sleep(2 ** attempt)
     
-    async def execute_query(self, query: str, *args):
-        """Execute a query and return results with retry logic"""
+    async def close_pool(self):
+        """Close the connection pool, waiting for in-flight queries to finish"""
+        async with self._pool_lock:
+            if self.pool:
+                await self.pool.close()
+                self.pool = None
+    
+    async def _run(self, method: str, query: str, *args):
+        """Run a connection method (fetch, fetchrow, fetchval, execute) with retry logic"""
         max_retries = 3
         for attempt in range(max_retries):
             try:
@@ -145,30 +188,76 @@ class DatabaseManager:
                     await self.init_pool()
                 
                 async with self.pool.acquire() as conn:
-                    return await conn.fetch(query, *args)
+                    return await getattr(conn, method)(query, *args)
             except (asyncpg.ConnectionDoesNotExistError, asyncpg.InterfaceError) as e:
-                logger.warning(f"Database connection error on query attempt {attempt + 1}: {e}")
+                logger.warning(f"Database connection error on {method} attempt {attempt + 1}: {e}")
                 self.pool = None  # Reset pool on connection error
                 if attempt == max_retries - 1:
                     raise
                 await asyncio.sleep(1 * (attempt + 1))
     
+    async def execute_query(self, query: str, *args):
+        """Execute a query and return results with retry logic"""
+        return await self._run("fetch", query, *args)
+    
+    async def fetchrow(self, query: str, *args):
+        """Execute a query and return the first row (or None) with retry logic"""
+        return await self._run("fetchrow", query, *args)
+    
+    async def fetchval(self, query: str, *args):
+        """Execute a query and return the first column of the first row (or None) with retry logic"""
+        return await self._run("fetchval", query, *args)
+    
     async def execute_command(self, command: str, *args):
         """Execute a command (INSERT, UPDATE, DELETE) with retry logic"""
-        max_retries = 3
-        for attempt in range(max_retries):
-            try:
-                if not self.pool:
-                    await self.init_pool()
-                
-                async with self.pool.acquire() as conn:
-                    return await conn.execute(command, *args)
-            except (asyncpg.ConnectionDoesNotExistError, asyncpg.InterfaceError) as e:
-                logger.warning(f"Database connection error on command attempt {attempt + 1}: {e}")
-                self.pool = None  # Reset pool on connection error
-                if attempt == max_retries - 1:
-                    raise
-                await asyncio.sleep(1 * (attempt + 1))
+        return await self._run("execute", command, *args)
+    
+    async def get_device_id(self, device_token: str) -> Optional[str]:
+        """Resolve a device token to its device_users.id, or None if unregistered
+        
+        Misses are not cached, so a device registered a moment ago is found.
+        """
+        device_id = self._device_ids.get(device_token)
+        if device_id is None:
+            device_id = await self.fetchval(DEVICE_ID_BY_TOKEN_SQL, device_token)
+            if device_id is not None:
+                self._device_ids[device_token] = device_id
+        return device_id
+    
+    async def refresh_device_id(self, device_token: str) -> Optional[str]:
+        """Re-resolve a device token, bypassing the cache
+        
+        For writes by a cached id that matched no row: the device may have been
+        deleted, or deleted and re-registered, by another worker within the TTL.
+        Returns the current id, or None if the device no longer exists.
+        """
+        cached = self._device_ids.get(device_token)
+        device_id = await self.fetchval(DEVICE_ID_BY_TOKEN_SQL, device_token)
+        if device_id != cached:
+            self.forget_device_tokens(device_token)
+        if device_id is not None:
+            self._device_ids[device_token] = device_id
+        return device_id
+    
+    def forget_device_profiles(self, *device_tokens: str):
+        """Drop cached profile bodies after a device's row changes"""
+        for device_token in device_tokens:
+            self.profile_cache.pop(device_token, None)
+    
+    def forget_device_tokens(self, *device_tokens: str):
+        """Drop everything cached for devices that were deleted or had their token replaced"""
+        for device_token in device_tokens:
+            self._device_ids.pop(device_token, None)
+        self.forget_device_profiles(*device_tokens)
+    
+    @asynccontextmanager
+    async def connection(self):
+        """Acquire a single pooled connection to reuse across several queries"""
+        if not self.pool:
+            await self.init_pool()
+        
+        async with self.pool.acquire() as conn:
+            yield conn
     
     async def transaction(self):
         """Get a transaction context"""
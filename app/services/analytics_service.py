@@ -2,34 +2,184 @@
 Analytics service for tracking user actions
 Simple wrapper around database operations for user_analytics table
 """
-import json
+import asyncio
+import asyncpg
+import orjson
 import logging
+import uuid
 from datetime import datetime, timezone
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Optional, List, Tuple
 
 from app.core.database import db_manager
 from app.services.privacy_analytics_service import privacy_analytics_service
 
 logger = logging.getLogger(__name__)
 
+# Consent is checked in the same statement: events from devices that have not
+# opted in (or no longer exist) are dropped by the join
+FLUSH_ANALYTICS_SQL = """
+    INSERT INTO iosapp.user_analytics (device_id, action, metadata, created_at)
+    SELECT e.device_id, e.action, e.metadata::jsonb, e.created_at
+    FROM unnest($1::uuid[], $2::text[], $3::text[], $4::timestamptz[])
+        AS e(device_id, action, metadata, created_at)
+    JOIN iosapp.device_users d ON d.id = e.device_id AND d.analytics_consent = true
+"""
+
+# Failures that say nothing about the rows themselves; the batch is worth retrying
+_CONNECTION_ERRORS = (asyncpg.InterfaceError, asyncpg.ConnectionDoesNotExistError, OSError, asyncio.TimeoutError)
+
+def _strip_nul(value):
+    """Remove NUL characters, which jsonb rejects, from strings nested in metadata"""
+    if isinstance(value, str):
+        return value.replace("\x00", "")
+    if isinstance(value, dict):
+        return {_strip_nul(k): _strip_nul(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_strip_nul(v) for v in value]
+    return value
+
 class AnalyticsService:
     """Service for tracking user analytics and actions"""
     
-    async def track_action(self, device_id: str, action: str, metadata: Optional[Dict[str, Any]] = None) -> bool:
+    FLUSH_BATCH_SIZE = 500
+    FLUSH_MAX_WAIT = 0.1  # seconds
+    QUEUE_MAX_SIZE = 10_000
+    ACTION_MAX_LENGTH = 100  # user_analytics.action is VARCHAR(100)
+    REQUEUE_DELAY = 1.0  # seconds to wait before retrying after a connection error
+    
+    def __init__(self):
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=self.QUEUE_MAX_SIZE)
+        self._flush_task: Optional[asyncio.Task] = None
+    
+    def track_action(self, device_id, action: str, metadata: Optional[Dict[str, Any]] = None) -> bool:
         """
-        Track a user action in the analytics table (PRIVACY-COMPLIANT)
-        Only tracks if user has consented to analytics
+        Queue a user action for the analytics table (PRIVACY-COMPLIANT)
+        Events are written in batches by the background flusher, which only
+        stores them if the user has consented to analytics
         
         Args:
-            device_id: UUID of the device user
+            device_id: UUID of the device user (str or UUID object)
             action: Action type (e.g., 'profile_view', 'preferences_update')
             metadata: Optional metadata dict
             
         Returns:
-            bool: True if successfully tracked (or skipped due to no consent), False if error
+            bool: True if queued, False if the event was invalid or dropped
         """
-        # Use privacy-compliant service that checks consent first
-        return await privacy_analytics_service.track_action_with_consent(device_id, action, metadata)
+        # One malformed row would fail the whole batched INSERT, so reject it here
+        if not self.is_valid_action(action):
+            logger.warning(f"Rejecting analytics action {action!r} for device {device_id}")
+            return False
+        try:
+            device_uuid = device_id if isinstance(device_id, uuid.UUID) else uuid.UUID(str(device_id))
+            self._queue.put_nowait((
+                device_uuid,
+                action,
+                orjson.dumps(_strip_nul(metadata or {})).decode(),
+                datetime.now(timezone.utc)
+            ))
+            return True
+        except asyncio.QueueFull:
+            logger.warning(f"Analytics queue full, dropping action {action} for device {device_id}")
+            return False
+        except Exception as e:
+            logger.error(f"Failed to queue action {action} for device {device_id}: {e}")
+            return False
+    
+    def is_valid_action(self, action) -> bool:
+        """Whether action can be stored in user_analytics.action"""
+        return (
+            isinstance(action, str)
+            and 0 < len(action) <= self.ACTION_MAX_LENGTH
+            and "\x00" not in action
+        )
+    
+    async def start_flusher(self):
+        """Start the background task that writes queued analytics events"""
+        if self._flush_task and not self._flush_task.done():
+            return
+        self._flush_task = asyncio.create_task(self._run_flusher())
+    
+    async def stop_flusher(self):
+        """Stop the flusher and write whatever is still queued"""
+        if self._flush_task:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        
+        # Take a snapshot so events requeued by a failed flush don't loop forever
+        pending = [self._queue.get_nowait() for _ in range(self._queue.qsize())]
+        for i in range(0, len(pending), self.FLUSH_BATCH_SIZE):
+            await self._flush(pending[i:i + self.FLUSH_BATCH_SIZE], requeue=False)
+    
+    async def _run_flusher(self):
+        """Flusher loop: at most FLUSH_MAX_WAIT between an event arriving and its write"""
+        while True:
+            batch = await self._drain()
+            await self._flush(batch)
+    
+    async def _drain(self) -> List[Tuple]:
+        """Wait for one event, then collect up to FLUSH_BATCH_SIZE within FLUSH_MAX_WAIT"""
+        batch = [await self._queue.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.FLUSH_MAX_WAIT
+        while len(batch) < self.FLUSH_BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+    
+    async def _flush(self, batch: List[Tuple], requeue: bool = True):
+        """
+        Write a batch of queued events in a single INSERT
+        
+        If a row is rejected the batch is split in halves and retried, so only the
+        bad event is lost; on connection errors the batch goes back on the queue.
+        """
+        if not batch:
+            return
+        try:
+            await self._insert(batch)
+            logger.debug(f"Flushed {len(batch)} analytics events")
+        except asyncpg.DataError as e:
+            if len(batch) == 1:
+                logger.error(f"Dropping analytics event {batch[0][1]} for device {batch[0][0]}: {e}")
+                return
+            mid = len(batch) // 2
+            await self._flush(batch[:mid], requeue)
+            await self._flush(batch[mid:], requeue)
+        except _CONNECTION_ERRORS as e:
+            if not requeue:
+                logger.error(f"Dropping {len(batch)} analytics events after connection error: {e}")
+                return
+            logger.warning(f"Requeueing {len(batch)} analytics events after connection error: {e}")
+            self._requeue(batch)
+            await asyncio.sleep(self.REQUEUE_DELAY)
+        except Exception as e:
+            logger.error(f"Failed to flush {len(batch)} analytics events: {e}")
+    
+    async def _insert(self, batch: List[Tuple]):
+        """Run FLUSH_ANALYTICS_SQL for a batch of queued events"""
+        device_ids, actions, metadata, created_at = zip(*batch)
+        await db_manager.execute_command(
+            FLUSH_ANALYTICS_SQL,
+            list(device_ids), list(actions), list(metadata), list(created_at)
+        )
+    
+    def _requeue(self, batch: List[Tuple]):
+        """Put events back for the next flush, dropping what no longer fits"""
+        for i, event in enumerate(batch):
+            try:
+                self._queue.put_nowait(event)
+            except asyncio.QueueFull:
+                logger.warning(f"Analytics queue full, dropping {len(batch) - i} requeued events")
+                return
     
     async def get_device_analytics(self, device_id: str, days: int = 30) -> Dict[str, Any]:
         """
@@ -64,11 +214,10 @@ class AnalyticsService:
                 SELECT COUNT(*) as count
                 FROM iosapp.user_analytics
                 WHERE device_id = $1 AND action = $2 
-                AND created_at >= NOW() - INTERVAL '%s days'
-            """ % days
+                AND created_at >= NOW() - make_interval(days => $3)
+            """
             
-            result = await db_manager.execute_query(query, device_id, action)
-            return result[0]['count'] if result else 0
+            return await db_manager.fetchval(query, device_id, action, days)
             
         except Exception as e:
             logger.error(f"Failed to get action count for {action}: {e}")
@@ -3,7 +3,7 @@ Minimal notification service with hash-based deduplication
 Works with truncate/load scraper approach
 """
 import logging
-import json
+import orjson
 import hashlib
 import asyncio
 from typing import List, Dict, Any, Optional
@@ -11,9 +11,8 @@ from datetime import datetime, timezone
 import uuid
 
 from app.core.database import db_manager
-from app.core.redis_client import redis_client
 from app.services.push_notifications import PushNotificationService
-from app.services.privacy_analytics_service import privacy_analytics_service
+from app.services.analytics_service import analytics_service
 
 logger = logging.getLogger(__name__)
 
@@ -45,12 +44,12 @@ class MinimalNotificationService:
         """Check if notification was already sent to device"""
         try:
             query = """
-                SELECT 1 FROM iosapp.notification_hashes 
-                WHERE device_id = $1 AND job_hash = $2
-                LIMIT 1
+                SELECT EXISTS (
+                    SELECT 1 FROM iosapp.notification_hashes 
+                    WHERE device_id = $1 AND job_hash = $2
+                )
             """
-            result = await db_manager.execute_query(query, device_id, job_hash)
-            return len(result) > 0
+            return await db_manager.fetchval(query, device_id, job_hash)
         except Exception as e:
             logger.error(f"Error checking notification hash: {e}")
             return False  # If error, allow sending to be safe
@@ -73,13 +72,13 @@ class MinimalNotificationService:
                 RETURNING id
             """
             
-            result = await db_manager.execute_query(
+            inserted_id = await db_manager.fetchval(
                 query, device_id, job_hash, job_title, company, 
-                job_source, json.dumps(matched_keywords), apply_link
+                job_source, orjson.dumps(matched_keywords).decode(), apply_link
             )
             
-            # If result is empty, notification already exists (duplicate)
-            is_first_time = len(result) > 0
+            # No id returned means the row already existed (duplicate)
+            is_first_time = inserted_id is not None
             
             if is_first_time:
                 # Record analytics for new notifications only
@@ -96,7 +95,7 @@ class MinimalNotificationService:
     async def track_notification_sent(self, device_id: str, matched_keywords: List[str]):
         """Track notification in analytics (with consent check)"""
         try:
-            await privacy_analytics_service.track_action_with_consent(
+            analytics_service.track_action(
                 device_id,
                 'notification_received',
                 {
@@ -125,13 +124,14 @@ class MinimalNotificationService:
             
             session_result = await db_manager.execute_query(
                 session_query, session_id, device_id, len(matched_jobs), 
-                json.dumps(matched_keywords)
+                orjson.dumps(matched_keywords).decode()
             )
             
             if not session_result:
                 raise Exception("Failed to create job match session")
             
             # Store all matched jobs in the session
+            job_records = []
             for i, job in enumerate(matched_jobs):
                 # CRITICAL FIX: Use original title for consistent session storage
                 original_title = job.get('original_title') or job.get('title', '')
@@ -142,24 +142,27 @@ class MinimalNotificationService:
                     job.get('id', '')
                 )
                 
-                job_insert_query = """
-                    INSERT INTO iosapp.job_match_session_jobs 
-                    (session_id, job_hash, job_title, job_company, job_source, apply_link, job_data, match_score)
-                    VALUES ($1, $2, $3, $4, $5, $6, $7, $8)
-                    ON CONFLICT (session_id, job_hash) DO NOTHING
-                """
-                
-                await db_manager.execute_query(
-                    job_insert_query,
+                job_records.append((
                     session_id,
                     job_hash,
                     original_title[:500],  # Use original title for database consistency
                     job.get('company', '')[:200],
                     job.get('source', '')[:100],
                     job.get('apply_link', ''),
-                    json.dumps(job),
+                    orjson.dumps(job).decode(),
                     1000 - i  # Higher score for earlier jobs (better matches)
-                )
+                ))
+            
+            job_insert_query = """
+                INSERT INTO iosapp.job_match_session_jobs 
+                (session_id, job_hash, job_title, job_company, job_source, apply_link, job_data, match_score)
+                VALUES ($1, $2, $3, $4, $5, $6, $7, $8)
+                ON CONFLICT (session_id, job_hash) DO NOTHING
+            """
+            
+            # One prepared statement and one connection for the whole batch
+            async with db_manager.connection() as conn:
+                await conn.executemany(job_insert_query, job_records)
             
             logger.info(f"Created job match session {session_id} with {len(matched_jobs)} jobs for device {device_id[:8]}...")
             return session_id
@@ -192,37 +195,15 @@ class MinimalNotificationService:
             
             result = await db_manager.execute_query(query)
             
-            devices = []
-            for row in result:
-                try:
-                    keywords_raw = row['keywords']
-                    
-                    # Handle JSONB field properly - same logic as chatbot
-                    if keywords_raw is None:
-                        keywords = []
-                    elif isinstance(keywords_raw, list):
-                        keywords = keywords_raw  # Already a list
-                    elif isinstance(keywords_raw, str):
-                        # Handle JSON string from database
-                        try:
-                            parsed = json.loads(keywords_raw)
-                            keywords = parsed if isinstance(parsed, list) else [str(parsed)]
-                        except (json.JSONDecodeError, TypeError):
-                            # Fallback: treat as single keyword
-                            keywords = [keywords_raw] if keywords_raw.strip() else []
-                    else:
-                        # Handle other types (e.g., dict, number)
-                        keywords = []
-                    
-                    if keywords:  # Only include devices with keywords
-                        devices.append({
-                            'device_id': str(row['id']),
-                            'device_token': row['device_token'],
-                            'keywords': keywords
-                        })
-                except Exception as e:
-                    logger.error(f"Error processing keywords for device {row['id']}: {e}")
-                    continue
+            # keywords is jsonb, decoded to a list by the pool codec
+            devices = [
+                {
+                    'device_id': str(row['id']),
+                    'device_token': row['device_token'],
+                    'keywords': row['keywords']
+                }
+                for row in result
+            ]
             
             logger.info(f"Found {len(devices)} active devices with keywords")
             return devices
@@ -394,27 +375,21 @@ class MinimalNotificationService:
             if not matching_jobs:
                 return {"matched": False, "notification_sent": False}
             
-            # Step 2: Bulk check for already sent notifications (single query)
+            # Step 2: Record notifications; ON CONFLICT skips hashes already sent, so the
+            # returned set is exactly the new jobs, even under concurrent runs (single query)
             if not dry_run:
-                already_sent_hashes = await self._bulk_check_notifications_sent(device_id, job_hashes)
+                new_hashes = await self._bulk_record_notifications(device_id, matching_jobs, job_hashes, user_keywords)
                 
                 # Filter out already sent jobs
-                new_jobs = []
-                new_hashes = []
-                for job, job_hash in zip(matching_jobs, job_hashes):
-                    if job_hash not in already_sent_hashes:
-                        new_jobs.append(job)
-                        new_hashes.append(job_hash)
+                matching_jobs = [
+                    job for job, job_hash in zip(matching_jobs, job_hashes)
+                    if job_hash in new_hashes
+                ]
                 
-                if not new_jobs:
+                if not matching_jobs:
                     return {"matched": True, "notification_sent": False}
-                
-                # Step 3: Bulk record notifications (single query)
-                await self._bulk_record_notifications(device_id, new_jobs, new_hashes, user_keywords)
-                
-                matching_jobs = new_jobs
             
-            # Step 4: Send enhanced notification representing ALL jobs
+            # Step 3: Send enhanced notification representing ALL jobs
             if matching_jobs:
                 # CRITICAL FIX: Check for significant job overlap with recent sessions
                 
@@ -431,11 +406,9 @@ class MinimalNotificationService:
                 """
                 
                 # Check how many jobs overlap with recent sessions
-                existing_overlap = await db_manager.execute_query(
+                overlap_count = await db_manager.fetchval(
                     overlap_check_query, device_id, job_hashes
                 )
-                
-                overlap_count = existing_overlap[0]['overlap_count'] if existing_overlap else 0
                 overlap_threshold = max(2, len(matching_jobs) * 0.7)  # 70% overlap or minimum 2 jobs
                 
                 if overlap_count >= overlap_threshold:
@@ -464,72 +437,44 @@ class MinimalNotificationService:
             logger.error(f"Error processing device {device_id[:8]}...: {e}")
             return {"matched": False, "notification_sent": False}
     
-    async def _bulk_check_notifications_sent(self, device_id: str, job_hashes: List[str]) -> set:
-        """Bulk check which notifications were already sent (single DB query)"""
+    async def _bulk_record_notifications(self, device_id: str, jobs: List[Dict], 
+                                        job_hashes: List[str], keywords: List[str]) -> set:
+        """Bulk record notifications (single INSERT ... SELECT FROM unnest)
+        
+        Returns the job hashes that were newly recorded; hashes already sent to the
+        device are skipped by ON CONFLICT and left out. On error nothing counts as new.
+        """
         try:
-            if not job_hashes:
+            if not jobs:
                 return set()
             
-            # Use ANY() for efficient bulk check
             query = """
-                SELECT job_hash FROM iosapp.notification_hashes 
-                WHERE device_id = $1 AND job_hash = ANY($2)
+                INSERT INTO iosapp.notification_hashes 
+                (device_id, job_hash, job_title, job_company, job_source, matched_keywords, apply_link, sent_at)
+                SELECT $1, t.job_hash, t.job_title, t.job_company, t.job_source, $6, t.apply_link, NOW()
+                FROM unnest($2::text[], $3::text[], $4::text[], $5::text[], $7::text[])
+                    AS t(job_hash, job_title, job_company, job_source, apply_link)
+                ON CONFLICT (device_id, job_hash) DO NOTHING
+                RETURNING job_hash
             """
-            result = await db_manager.execute_query(query, device_id, job_hashes)
-            return {row['job_hash'] for row in result}
-        except Exception as e:
-            logger.error(f"Error in bulk notification check: {e}")
-            return set()
-    
-    async def _bulk_record_notifications(self, device_id: str, jobs: List[Dict], 
-                                        job_hashes: List[str], keywords: List[str]):
-        """TRUE BULK record notifications (single DB query using executemany)"""
-        try:
-            if not jobs:
-                return
             
-            # Prepare all records for bulk insert
-            records = []
-            keywords_json = json.dumps(keywords[:3])  # Convert once
+            result = await db_manager.execute_query(
+                query,
+                device_id,
+                job_hashes,
+                [job.get('title', '') for job in jobs],
+                [job.get('company', '') for job in jobs],
+                [job.get('source', '') for job in jobs],
+                orjson.dumps(keywords[:3]).decode(),
+                [job.get('apply_link') for job in jobs]
+            )
             
-            for job, job_hash in zip(jobs, job_hashes):
-                records.append((
-                    device_id,
-                    job_hash,
-                    job.get('title', ''),
-                    job.get('company', ''),
-                    job.get('source', ''),
-                    keywords_json,
-                    job.get('apply_link')
-                ))
+            logger.debug(f"Bulk recorded {len(result)} of {len(jobs)} notifications for device {device_id[:8]}...")
+            return {row['job_hash'] for row in result}
             
-            if records:
-                # True bulk insert using executemany
-                query = """
-                    INSERT INTO iosapp.notification_hashes 
-                    (device_id, job_hash, job_title, job_company, job_source, matched_keywords, apply_link, sent_at)
-                    VALUES ($1, $2, $3, $4, $5, $6, $7, NOW())
-                    ON CONFLICT (device_id, job_hash) DO NOTHING
-                """
-                
-                try:
-                    # Use asyncpg's executemany for true bulk performance
-                    pool = db_manager.pool
-                    async with pool.acquire() as conn:
-                        await conn.executemany(query, records)
-                    
-                    logger.debug(f"Bulk recorded {len(records)} notifications for device {device_id[:8]}...")
-                except Exception as bulk_error:
-                    # Fallback to individual inserts if bulk fails
-                    logger.warning(f"Bulk insert failed, falling back to individual inserts: {bulk_error}")
-                    for record in records:
-                        try:
-                            await db_manager.execute_command(query, *record)
-                        except Exception as individual_error:
-                            logger.error(f"Failed to record individual notification: {individual_error}")
-                            
         except Exception as e:
             logger.error(f"Error in bulk notification recording: {e}")
+            return set()
 
     def _create_multi_job_notification(self, matching_jobs: List[Dict], session_id: str, 
                                      matched_keywords: List[str]) -> Dict:
@@ -669,44 +614,21 @@ class MinimalNotificationService:
                                     job.get('id', '')
                                 )
                                 
-                                # Use distributed lock to prevent race conditions
-                                lock_key = f"notification_lock:{device_id}:{job_hash}"
-                                
                                 if not dry_run:
-                                    # Try to acquire lock for this notification
-                                    try:
-                                        async with redis_client.lock(lock_key, timeout=5):
-                                            # Check if already sent (inside lock)
-                                            already_sent = await self.is_notification_already_sent(device_id, job_hash)
-                                            if not already_sent:
-                                                # Record notification
-                                                notification_recorded = await self.record_notification_sent(
-                                                    device_id, job_hash, 
-                                                    job.get('title', ''), job.get('company', ''),
-                                                    job.get('source', ''), matched_keywords,
-                                                    job.get('apply_link')
-                                                )
-                                                
-                                                if notification_recorded:
-                                                    job_copy = job.copy()
-                                                    job_copy['original_title'] = job.get('title', '')
-                                                    matching_jobs.append(job_copy)
-                                                    all_matched_keywords.update(matched_keywords)
-                                    except Exception as lock_error:
-                                        logger.warning(f"Failed to acquire lock for {device_id}:{job_hash}: {lock_error}")
-                                        # Fallback to database-only deduplication
-                                        notification_recorded = await self.record_notification_sent(
-                                            device_id, job_hash, 
-                                            job.get('title', ''), job.get('company', ''),
-                                            job.get('source', ''), matched_keywords,
-                                            job.get('apply_link')
-                                        )
-                                        
-                                        if notification_recorded:
-                                            job_copy = job.copy()
-                                            job_copy['original_title'] = job.get('title', '')
-                                            matching_jobs.append(job_copy)
-                                            all_matched_keywords.update(matched_keywords)
+                                    # ON CONFLICT (device_id, job_hash) DO NOTHING decides atomically
+                                    # whether this is the first send, so no pre-check or lock is needed
+                                    notification_recorded = await self.record_notification_sent(
+                                        device_id, job_hash, 
+                                        job.get('title', ''), job.get('company', ''),
+                                        job.get('source', ''), matched_keywords,
+                                        job.get('apply_link')
+                                    )
+                                    
+                                    if notification_recorded:
+                                        job_copy = job.copy()
+                                        job_copy['original_title'] = job.get('title', '')
+                                        matching_jobs.append(job_copy)
+                                        all_matched_keywords.update(matched_keywords)
                                 else:
                                     # In dry run mode, still check if already sent
                                     already_sent = await self.is_notification_already_sent(device_id, job_hash)
@@ -751,11 +673,9 @@ class MinimalNotificationService:
                                 AND jmsj.job_hash = ANY($2)
                             """
                             
-                            existing_overlap = await db_manager.execute_query(
+                            overlap_count = await db_manager.fetchval(
                                 overlap_check_query, device_id, device_job_hashes
                             )
-                            
-                            overlap_count = existing_overlap[0]['overlap_count'] if existing_overlap else 0
                             overlap_threshold = max(2, len(matching_jobs) * 0.7)  # 70% overlap or minimum 2 jobs
                             
                             if overlap_count >= overlap_threshold:
@@ -814,11 +734,11 @@ class MinimalNotificationService:
         try:
             query = """
                 DELETE FROM iosapp.notification_hashes 
-                WHERE sent_at < NOW() - INTERVAL '%s days'
+                WHERE sent_at < NOW() - make_interval(days => $1)
                 RETURNING id
-            """ % days_old
+            """
             
-            result = await db_manager.execute_query(query)
+            result = await db_manager.execute_query(query, days_old)
             deleted_count = len(result)
             
             logger.info(f"Cleaned up {deleted_count} notification hashes older than {days_old} days")
@@ -2,11 +2,11 @@
 Privacy-compliant analytics service
 GDPR/CCPA compliant analytics tracking with user consent
 """
-import json
+import asyncio
 import logging
 import uuid
 from datetime import datetime, timezone
-from typing import Dict, Any, Optional, Tuple
+from typing import Dict, Any, List, Optional, Tuple, AsyncIterator
 
 from app.core.database import db_manager
 
@@ -38,11 +38,7 @@ class PrivacyAnalyticsService:
             else:
                 device_uuid = device_id  # Already a UUID object
             
-            result = await db_manager.execute_query(query, device_uuid)
-            
-            if result and result[0]['analytics_consent']:
-                return True
-            return False
+            return bool(await db_manager.fetchval(query, device_uuid))
             
         except Exception as e:
             logger.error(f"Error checking analytics consent for device {str(device_id)}: {e}")
@@ -61,22 +57,22 @@ class PrivacyAnalyticsService:
             bool: True if tracked (or skipped due to no consent), False if error
         """
         try:
-            # Check consent first
-            has_consent = await self.check_analytics_consent(device_id)
-            
-            if not has_consent:
-                logger.debug(f"Skipping analytics tracking for device {device_id} - no consent")
-                return True  # Not an error, just no consent
-            
-            # User has consented, track the action
-            metadata_json = json.dumps(metadata or {})
-            
+            # Consent check and insert in one statement: no row is written unless
+            # the user has consented
             query = """
                 INSERT INTO iosapp.user_analytics (device_id, action, metadata, created_at)
-                VALUES ($1, $2, $3, NOW())
+                SELECT id, $2::text, $3::jsonb, NOW()
+                FROM iosapp.device_users
+                WHERE id = $1 AND analytics_consent = true
             """
             
-            await db_manager.execute_command(query, uuid.UUID(device_id), action, metadata_json)
+            device_uuid = device_id if isinstance(device_id, uuid.UUID) else uuid.UUID(str(device_id))
+            status = await db_manager.execute_command(query, device_uuid, action, metadata or {})
+            
+            if status == "INSERT 0 0":
+                logger.debug(f"Skipping analytics tracking for device {device_id} - no consent")
+                return True  # Not an error, just no consent
+            
             logger.debug(f"Analytics tracked for device {device_id}: {action}")
             return True
             
@@ -115,9 +111,7 @@ class PrivacyAnalyticsService:
                 await db_manager.execute_command(query, device_uuid, consent, privacy_policy_version)
                 logger.info(f"Analytics consent granted for device {device_id}")
             else:
-                # User is revoking consent - delete existing analytics data
-                await self.delete_analytics_data(str(device_uuid))
-                
+                # User is revoking consent - stop collection first, then delete existing analytics data
                 query = """
                     UPDATE iosapp.device_users 
                     SET analytics_consent = $2, 
@@ -126,6 +120,7 @@ class PrivacyAnalyticsService:
                     WHERE id = $1
                 """
                 await db_manager.execute_command(query, device_uuid, consent, privacy_policy_version)
+                await self._delete_analytics_in_batches(device_uuid)
                 logger.info(f"Analytics consent revoked and data deleted for device {device_id}")
             
             return True
@@ -134,6 +129,41 @@ class PrivacyAnalyticsService:
             logger.error(f"Failed to set analytics consent for device {device_id}: {e}")
             return False
     
+    async def set_analytics_consent_by_token(self, device_token: str, consent: bool, privacy_policy_version: str = "1.0") -> Optional[str]:
+        """
+        Set analytics consent resolving the device by token in the update itself
+        
+        Args:
+            device_token: Validated device token
+            consent: True to consent, False to revoke (also deletes existing analytics data)
+            privacy_policy_version: Version of privacy policy user agreed to
+            
+        Returns:
+            Device user id (str), or None if the device is not registered
+        """
+        device_id = await self._update_consent_by_token(device_token, consent, privacy_policy_version)
+        if not device_id:
+            return None
+        
+        if not consent:
+            # Consent is already revoked, so no new events arrive while existing ones are deleted
+            await self._delete_analytics_in_batches(device_id)
+        
+        logger.info(f"Analytics consent {'granted' if consent else 'revoked and data deleted'} for device {device_id}")
+        return device_id
+    
+    async def _update_consent_by_token(self, device_token: str, consent: bool, privacy_policy_version: str) -> Optional[str]:
+        """Update consent columns for a device token, returning its id (None if not registered)"""
+        query = """
+            UPDATE iosapp.device_users 
+            SET analytics_consent = $2, 
+                consent_date = CASE WHEN $2 THEN NOW() END, 
+                privacy_policy_version = $3
+            WHERE device_token = $1
+            RETURNING id
+        """
+        return await db_manager.fetchval(query, device_token, consent, privacy_policy_version)
+    
     async def delete_analytics_data(self, device_id) -> int:
         """
         Delete all analytics data for a user (GDPR right to be forgotten)
@@ -151,21 +181,70 @@ class PrivacyAnalyticsService:
             else:
                 device_uuid = device_id  # Already a UUID object
             
-            query = """
-                DELETE FROM iosapp.user_analytics 
-                WHERE device_id = $1
-            """
-            
-            result = await db_manager.execute_command(query, device_uuid)
+            deleted_count = await self._delete_analytics_in_batches(device_uuid)
             logger.info(f"Deleted analytics data for device {device_id}")
             
-            # Return count would need a different approach with asyncpg
-            return result if isinstance(result, int) else 0
+            return deleted_count
             
         except Exception as e:
             logger.error(f"Failed to delete analytics data for device {device_id}: {e}")
             return 0
     
+    async def delete_and_revoke_by_token(self, device_token: str) -> Tuple[Optional[str], int]:
+        """
+        Revoke consent and delete all analytics data, resolving the device by token
+        
+        Consent is revoked before any data is deleted, so there is no window where
+        data is gone but collection is still allowed. The batched deletes commit
+        one by one; a failure part-way leaves consent revoked with some events
+        remaining, and calling this again deletes the rest.
+        
+        Args:
+            device_token: Validated device token
+            
+        Returns:
+            Tuple[device_id, deleted_count]: device_id is None if the device is not registered
+        """
+        device_id = await self._update_consent_by_token(device_token, False, "data_deleted")
+        if not device_id:
+            return None, 0
+        
+        deleted_count = await self._delete_analytics_in_batches(device_id)
+        logger.info(f"Analytics consent revoked and {deleted_count} events deleted for device {device_id}")
+        return device_id, deleted_count
+    
+    async def _delete_analytics_in_batches(self, device_id, batch_size: int = 10000) -> int:
+        """
+        Delete a device's analytics events in bounded batches
+        
+        Each statement touches at most batch_size rows and commits on its own, so
+        heavy devices don't hold row locks long enough to stall other writers.
+        
+        Returns:
+            int: Number of records deleted
+        """
+        query = """
+            WITH batch AS (
+                SELECT ctid FROM iosapp.user_analytics 
+                WHERE device_id = $1 
+                LIMIT $2
+            ), deleted AS (
+                DELETE FROM iosapp.user_analytics 
+                WHERE ctid IN (SELECT ctid FROM batch)
+                RETURNING 1
+            )
+            SELECT COUNT(*) FROM deleted
+        """
+        
+        total_deleted = 0
+        while True:
+            deleted = await db_manager.fetchval(query, device_id, batch_size)
+            total_deleted += deleted
+            if deleted < batch_size:
+                return total_deleted
+            # Let other requests run between batches
+            await asyncio.sleep(0)
+    
     async def get_analytics_summary_anonymous(self) -> Dict[str, Any]:
         """
         Get anonymous analytics summary (no user-identifiable data)
@@ -191,16 +270,18 @@ class PrivacyAnalyticsService:
             
             summary = {}
             
-            for key, query in queries.items():
-                try:
-                    result = await db_manager.execute_query(query)
-                    if key in ["total_active_users", "total_actions_7d"]:
-                        summary[key] = result[0]['count'] if result else 0
-                    else:
-                        summary[key] = [dict(row) for row in result] if result else []
-                except Exception as e:
-                    logger.error(f"Error executing query {key}: {e}")
-                    summary[key] = 0 if key in ["total_active_users", "total_actions_7d"] else []
+            # One connection for all three aggregates instead of an acquire per query
+            async with db_manager.connection() as conn:
+                for key, query in queries.items():
+                    try:
+                        if key in ["total_active_users", "total_actions_7d"]:
+                            summary[key] = await conn.fetchval(query) or 0
+                        else:
+                            result = await conn.fetch(query)
+                            summary[key] = [dict(row) for row in result] if result else []
+                    except Exception as e:
+                        logger.error(f"Error executing query {key}: {e}")
+                        summary[key] = 0 if key in ["total_active_users", "total_actions_7d"] else []
             
             return {
                 "anonymous_summary": summary,
@@ -317,11 +398,11 @@ class PrivacyAnalyticsService:
             """
             
             analytics_data = await db_manager.execute_query(analytics_query, device_uuid)
-            device_data = await db_manager.execute_query(device_query, device_uuid)
+            device_data = await db_manager.fetchrow(device_query, device_uuid)
             
             return {
                 "export_date": datetime.now(timezone.utc).isoformat(),
-                "device_info": dict(device_data[0]) if device_data else {},
+                "device_info": dict(device_data) if device_data else {},
                 "analytics_events": [
                     {
                         "action": row['action'],
@@ -338,5 +419,57 @@ class PrivacyAnalyticsService:
             logger.error(f"Failed to export user data for device {device_id}: {e}")
             return {"error": "Failed to export user data"}
 
+    async def get_export_device(self, device_token: str):
+        """
+        Get the device row used for a data export, resolved by token
+        
+        Args:
+            device_token: Validated device token
+            
+        Returns:
+            Record with device data and analytics_consent, or None if not registered
+        """
+        query = """
+            SELECT id, device_token, keywords, notifications_enabled, analytics_consent, 
+                   consent_date, privacy_policy_version, created_at
+            FROM iosapp.device_users
+            WHERE device_token = $1
+        """
+        return await db_manager.fetchrow(query, device_token)
+    
+    async def iter_analytics_event_pages(self, device_id, page_size: int = 500) -> AsyncIterator[List[Any]]:
+        """
+        Page through a device's analytics events newest-first with keyset fetches
+        
+        Each page is a separate query on a freshly acquired pooled connection, so no
+        connection is held while the caller consumes a page. Memory stays bounded by
+        the page size regardless of history length.
+        
+        Args:
+            device_id: UUID of the device user
+            page_size: Rows fetched per query
+            
+        Yields:
+            Lists of records with id, action, metadata and created_at
+        """
+        query = """
+            SELECT id, action, metadata, created_at 
+            FROM iosapp.user_analytics
+            WHERE device_id = $1
+              AND ($2::timestamptz IS NULL OR (created_at, id) < ($2, $3))
+            ORDER BY created_at DESC, id DESC
+            LIMIT $4
+        """
+        
+        before_at, before_id = None, None
+        while True:
+            page = await db_manager.execute_query(query, device_id, before_at, before_id, page_size)
+            if not page:
+                return
+            yield page
+            if len(page) < page_size:
+                return
+            before_at, before_id = page[-1]['created_at'], page[-1]['id']
+
 # Global instance
 privacy_analytics_service = PrivacyAnalyticsService()
\ No newline at end of file
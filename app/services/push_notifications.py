@@ -2,6 +2,7 @@ import asyncio
 import logging
 from typing import Dict, Any, List, Optional
 from datetime import datetime, timezone
+import string
 import uuid
 import json
 import traceback
@@ -813,9 +814,7 @@ class PushNotificationService:
             return False
         
         # Should only contain hex characters
-        try:
-            int(device_token, 16)
-        except ValueError:
+        if device_token.strip(string.hexdigits):
             self.logger.error(f"Invalid token format: contains non-hex characters")
             return False
         
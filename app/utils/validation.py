@@ -2,8 +2,18 @@
 Validation utilities for data integrity
 """
 from fastapi import HTTPException
+from functools import lru_cache
+import logging
 import re
 
+logger = logging.getLogger(__name__)
+
+# Compiled once at import; each check is a single C-level match
+_HEX_TOKEN_MATCH = re.compile(r'[0-9a-fA-F]{64}|[0-9a-fA-F]{128}|[0-9a-fA-F]{160}').fullmatch
+_HEX_MATCH = re.compile(r'[0-9a-fA-F]+').fullmatch
+_NON_HEX_SUB = re.compile(r'[^0-9a-fA-F]').sub
+_EMAIL_MATCH = re.compile(r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$').match
+
 def validate_device_token(device_token: str) -> str:
     """
     Validate APNs device token format and prevent bad data entry
@@ -23,62 +33,37 @@ def validate_device_token(device_token: str) -> str:
     if not isinstance(device_token, str):
         raise HTTPException(status_code=400, detail="device_token must be a string")
     
+    return _validate_device_token_str(device_token)
+
+@lru_cache(maxsize=10_000)
+def _validate_device_token_str(device_token: str) -> str:
+    """
+    Format checks for validate_device_token, memoized per raw token string
+    
+    Repeat calls from the same device skip re-validation; invalid tokens raise
+    and are therefore never cached.
+    """
     # Clean whitespace
     device_token = device_token.strip()
     
     # Handle different token formats from iOS
-    # Case 1: 64 hex characters (32 bytes - standard APNs token)
-    if len(device_token) == 64:
-        try:
-            int(device_token, 16)
-            # Valid 64-character hex token
-            pass
-        except ValueError:
-            raise HTTPException(
-                status_code=400, 
-                detail="device_token must contain only hexadecimal characters (0-9, a-f)"
-            )
-    
-    # Case 2: 128 characters (64 bytes - newer APNs token format)
-    elif len(device_token) == 128:
-        try:
-            int(device_token, 16)
-            # Valid 128-character hex token (64 bytes)
-            pass
-        except ValueError:
-            raise HTTPException(
-                status_code=400, 
-                detail="device_token must contain only hexadecimal characters (0-9, a-f)"
-            )
+    # Case 1-3: 64, 128 or 160 hex characters (32/64/80-byte APNs tokens) - the hot path
+    if _HEX_TOKEN_MATCH(device_token):
+        pass
     
-    # Case 3: 160 characters (80 bytes - extended APNs token format)
-    elif len(device_token) == 160:
-        try:
-            int(device_token, 16)
-            # Valid 160-character hex token (80 bytes)
-            # Some iOS configurations can generate longer tokens
-            pass
-        except ValueError:
-            raise HTTPException(
-                status_code=400, 
-                detail="device_token must contain only hexadecimal characters (0-9, a-f)"
-            )
+    elif len(device_token) in (64, 128, 160):
+        raise HTTPException(
+            status_code=400, 
+            detail="device_token must contain only hexadecimal characters (0-9, a-f)"
+        )
     
     # Case 3: Data.description format with spaces/brackets (extract hex)
     elif '<' in device_token and '>' in device_token:
         # Handle iOS Data.description format: "<801845f8 5177a58d ...>"
-        import re
-        hex_only = re.sub(r'[^0-9a-fA-F]', '', device_token)
+        hex_only = _NON_HEX_SUB('', device_token)
         
         if len(hex_only) in [64, 128, 160]:  # Accept 32-byte, 64-byte, and 80-byte tokens
-            try:
-                int(hex_only, 16)
-                device_token = hex_only.lower()  # Normalize to lowercase
-            except ValueError:
-                raise HTTPException(
-                    status_code=400, 
-                    detail="Invalid hexadecimal characters in device token"
-                )
+            device_token = hex_only.lower()  # Normalize to lowercase
         else:
             raise HTTPException(
                 status_code=400, 
@@ -90,14 +75,12 @@ def validate_device_token(device_token: str) -> str:
         # Accept UUID format like "367345C0-ACD8-4349-B21A-EDE0835E309B"
         uuid_clean = device_token.replace('-', '').lower()
         if len(uuid_clean) == 32:
-            try:
-                int(uuid_clean, 16)
-                device_token = uuid_clean  # Use cleaned version
-            except ValueError:
+            if not _HEX_MATCH(uuid_clean):
                 raise HTTPException(
                     status_code=400, 
                     detail="Invalid characters in device token (UUID format must be valid hex)"
                 )
+            device_token = uuid_clean  # Use cleaned version
         else:
             raise HTTPException(
                 status_code=400, 
@@ -128,8 +111,6 @@ def validate_device_token(device_token: str) -> str:
     
     # Check for repeating character patterns (like "aaa...aaa") - likely security probes
     if len(set(device_token)) <= 2:  # Only 1-2 unique characters
-        import logging
-        logger = logging.getLogger(__name__)
         logger.warning(f"Security probe detected: device_token with {len(set(device_token))} unique chars, length {len(device_token)}")
         raise HTTPException(
             status_code=400, 
@@ -186,8 +167,7 @@ def validate_email(email: str) -> str:
     email = email.strip().lower()
     
     # Basic email validation
-    email_pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
-    if not re.match(email_pattern, email):
+    if not _EMAIL_MATCH(email):
         raise HTTPException(status_code=400, detail="Invalid email format")
     
     return email
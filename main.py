@@ -4,11 +4,15 @@ Main FastAPI application for iOS Job App Backend
 
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 import logging
 from contextlib import asynccontextmanager
 
 from app.api.v1.router import api_router
+from app.core.database import db_manager
 from app.services.notification_scheduler import notification_scheduler
+from app.services.analytics_service import analytics_service
+from app.services.minimal_notification_service import minimal_notification_service
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -19,8 +23,19 @@ async def lifespan(app: FastAPI):
     """Manage application lifespan (startup and shutdown)"""
     # Startup
     logger.info("Starting iOS Job App Backend...")
+    # Open the pool up front so the first requests don't pay for connecting;
+    # if the database is unreachable the pool is still created lazily later
+    try:
+        await db_manager.init_pool()
+    except Exception as e:
+        logger.warning(f"Database pool not initialized at startup: {e}")
     await notification_scheduler.start_scheduler()
     logger.info("Notification scheduler started")
+    await analytics_service.start_flusher()
+    logger.info("Analytics flusher started")
+    # Build the shared APNs client now rather than on the first push request
+    if await minimal_notification_service.push_service._get_apns_client():
+        logger.info("APNs client initialized")
     
     yield
     
@@ -28,6 +43,10 @@ async def lifespan(app: FastAPI):
     logger.info("Shutting down iOS Job App Backend...")
     await notification_scheduler.stop_scheduler()
     logger.info("Notification scheduler stopped")
+    await analytics_service.stop_flusher()
+    logger.info("Analytics flusher stopped")
+    await db_manager.close_pool()
+    logger.info("Database pool closed")
 
 # Create FastAPI app
 app = FastAPI(
@@ -48,6 +67,9 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Compress JSON responses; tiny bodies are not worth the CPU
+app.add_middleware(GZipMiddleware, minimum_size=512)
+
 # Include API routes
 app.include_router(api_router, prefix="/api/v1")
 